@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+'''
+throughput baselines of the question generators
+
+Runs every q type of GENERATE on its own, on the same slice of a pgn file
+with the same seed, and reports for each
+
+ - questions per second,
+ - positions replayed per question written, the rejection ratio, and
+   the offers of a position to the q type per question,
+ - the seconds spent rendering and writing the questions,
+
+along with the seconds spent indexing the pgn file and parsing its games
+into move arrays, with no cache files. The results are saved as json:
+
+	python bench.py --out bench-$(git rev-parse --short HEAD).json
+	python bench.py --compare bench-1363944.json
+
+runs the benchmark again and prints how every figure changed since.
+'''
+
+import argparse, json, os, platform, shutil, subprocess, sys, tempfile, time
+import generate_qa as g
+import output
+from features import FeatureTable
+from pgn_index import PGNIndex, MoveCache
+
+class Timed(object):
+	'''Wraps a function, counting its calls and the seconds they take.'''
+	def __init__(self, function):
+		self.function = function
+		self.calls = 0
+		self.seconds = 0.0
+
+	def __call__(self, *args, **kwargs):
+		start = time.time()
+		try:
+			return self.function(*args, **kwargs)
+		finally:
+			self.seconds += time.time() - start
+			self.calls += 1
+
+def commit():
+	'''returns the commit of the working tree, None outside of git'''
+	try:
+		return subprocess.check_output(['git','rev-parse','HEAD'],stderr = open(os.devnull,'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def parse(pgn_file, n_matches, work):
+	'''
+	indexes and encodes the first n_matches games of a fresh copy of
+	pgn_file. returns the games and the seconds each step took
+	'''
+	pgn_copy = os.path.join(work,os.path.basename(pgn_file))
+	shutil.copyfile(pgn_file,pgn_copy)
+	start = time.time()
+	index = PGNIndex(pgn_copy)
+	indexed = time.time()
+	if n_matches >= 0:
+		index = index[:n_matches]
+	games = MoveCache(index)
+	encoded = time.time()
+	plies = sum(len(games[i]) for i in xrange(len(games)))
+	return games, {'games' : len(games), 'plies' : plies, 'index_seconds' : indexed - start, 'encode_seconds' : encoded - indexed}
+
+def bench(q_type, games, total_count, seed, work):
+	'''generates total_count questions of q_type and measures where time went'''
+	path = os.path.join(work,'q'+str(q_type))
+	output.FileWriter.prepare(path,[q_type])
+	g.PATH = path
+	g.WRITER = output.FileWriter(path)
+	write = Timed(g.WRITER.write)
+	g.WRITER.write = write
+	render = output.encode_png = Timed(output.encode_png)
+	ask = g.ask = Timed(g.ask)
+	g.random.seed(seed)
+	g.METRICS.setup(0,None)
+
+	start = time.time()
+	try:
+		quota, = g.generate([q_type],games,total_count)
+	finally:
+		seconds = time.time() - start
+		g.ask = ask.function
+		output.encode_png = render.function
+	g.WRITER.close()
+	positions = g.METRICS.counters['positions']
+	return {
+		'questions' : quota.total,
+		'seconds' : seconds,
+		'questions_per_second' : quota.total / seconds if seconds else 0.0,
+		'positions' : positions,
+		'positions_per_question' : float(positions) / quota.total if quota.total else None,
+		'offers' : ask.calls,
+		'offers_per_question' : float(ask.calls) / quota.total if quota.total else None,
+		'render_seconds' : render.seconds,
+		'write_seconds' : write.seconds - render.seconds,
+	}
+
+def compare(old, new):
+	'''prints the change of every figure of new from old'''
+	def change(a, b):
+		if not a or b is None:
+			return "{} -> {}".format(a,b)
+		return "{:.4g} -> {:.4g} ({:+.1f}%)".format(a,b,100.0 * (b - a) / a)
+	print >> sys.stderr, "since", old.get('commit')
+	for figure in sorted(new['parse']):
+		print >> sys.stderr, "parse", figure, ":", change(old['parse'].get(figure),new['parse'][figure])
+	for q_type in sorted(new['types'],key = int):
+		if q_type not in old['types']:
+			continue
+		for figure in ['questions_per_second','positions_per_question','offers_per_question','render_seconds','write_seconds']:
+			print >> sys.stderr, "type", q_type, figure, ":", change(old['types'][q_type].get(figure),new['types'][q_type][figure])
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--pgn-file', action='store', dest='pgn_file',help='pgn file to take the games from, default = data/stalemate.pgn',default = 'data/stalemate.pgn')
+	parser.add_argument('--matches', action='store', dest='n_matches',help='# of games from the start of the file, default = 300',type=int,default = 300)
+	parser.add_argument('--q-type', action='store', dest='q_type',help='q types to run, as in generate_qa.py, default = 0-14',default = '0-14')
+	parser.add_argument('--total-count', action='store', dest='total_count',help='# of questions per q type, default = 100',type=int,default = 100)
+	parser.add_argument('--seed', action='store', dest='seed',help='random seed, default = 0',type=int,default = 0)
+	parser.add_argument('--features', action='store_true', dest='features',help='answer from the feature table, as generate_qa.py --features')
+	parser.add_argument('--time-budget', action='store', dest='time_budget',help='give up on a q type after this many seconds, default = 120',type=float,default = 120)
+	parser.add_argument('--out', action='store', dest='out',help='json file to save the results in',default = None)
+	parser.add_argument('--compare', action='store', dest='compare',help='json file of an earlier run to compare the results with',default = None)
+	p = parser.parse_args()
+
+	bounds = [int(t) for t in p.q_type.split('-')]
+	q_types = range(bounds[0],bounds[-1] + 1)
+	g.CHECKPOINT_EVERY = 0
+	g.TIME_BUDGET = p.time_budget
+
+	work = tempfile.mkdtemp(prefix = 'bench-')
+	try:
+		games, parsed = parse(p.pgn_file,p.n_matches,work)
+		if p.features:
+			start = time.time()
+			g.FEATURES = FeatureTable(games)
+			parsed['features_seconds'] = time.time() - start
+		print >> sys.stderr, "parsed {games} games, {plies} plies in {index_seconds:.2f}s + {encode_seconds:.2f}s".format(**parsed)
+		results = {}
+		for q_type in q_types:
+			results[str(q_type)] = r = bench(q_type,games,p.total_count,p.seed,work)
+			print >> sys.stderr, "type {} : {} questions, {:.1f} questions/s, {} positions and {} offers per question, render {:.2f}s, write {:.2f}s".format(q_type,r['questions'],r['questions_per_second'],"{:.1f}".format(r['positions_per_question']) if r['positions_per_question'] else '-',"{:.1f}".format(r['offers_per_question']) if r['offers_per_question'] else '-',r['render_seconds'],r['write_seconds'])
+	finally:
+		shutil.rmtree(work,ignore_errors = True)
+
+	report = {
+		'commit' : commit(),
+		'python' : platform.python_version(),
+		'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'options' : vars(p),
+		'parse' : parsed,
+		'types' : results,
+	}
+	if p.out:
+		with open(p.out,'w') as f:
+			json.dump(report,f,sort_keys = True,indent = 1)
+	if p.compare:
+		with open(p.compare) as f:
+			compare(json.load(f),report)
@@ -0,0 +1,337 @@
+#! /usr/bin/env python
+'''
+per position features of a corpus of games
+
+The facts most question types ask about (piece counts, material,
+castling, check, checkmate and stalemate) are computed once for every
+position of every game and stored column by column in
+<pgn file>.features. Questions are then answered by looking them up.
+Attacks depend on where the pieces stand and are computed from the board
+when a question needs them, once per position.
+
+	python features.py --pgn-file data/stalemate.pgn --matches -1
+
+builds the table ahead of a run of generate_qa.py --features.
+'''
+
+import chess, os, sys
+from array import array
+from pgn_index import decode_move
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+PIECE_VAL = {1 : 1, 2 : 3 , 3: 3 , 4 : 5 , 5 : 9}
+FEATURES_VERSION = 2
+
+# bits of the flags column
+WHITE_RIGHTS = 1
+BLACK_RIGHTS = 2
+WHITE_CASTLE = 4
+BLACK_CASTLE = 8
+CHECK = 16
+CHECKMATE = 32
+STALEMATE = 64
+WHITE_TURN = 128
+RIGHTS = {True : WHITE_RIGHTS, False : BLACK_RIGHTS}
+CASTLE = {True : WHITE_CASTLE, False : BLACK_CASTLE}
+
+def check_castling(board,side):
+
+	if (chess.Move.from_uci("e1g1") in board.legal_moves and side == True) or (chess.Move.from_uci("e1c1") in board.legal_moves and side == True) or (chess.Move.from_uci("e8g8") in board.legal_moves and side == False) or (chess.Move.from_uci("e8c8") in board.legal_moves and side == False):
+		return True
+	return False
+
+def calculate_material(board,side):
+	m = 0
+	for piece in xrange(1,6):
+		m += len(list(board.pieces(piece,side)))*PIECE_VAL[piece]
+	return m
+
+def count_slot(side, piece_type):
+	'''Return the position of a (side, piece type) count in a row.'''
+	return (0 if side else 6) + piece_type - 1
+
+def board_masks(board):
+	'''Return the 12 piece bitboards of a position in count order.'''
+	return [board.pieces_mask(piece_type,side) for side in (True,False) for piece_type in xrange(1,7)]
+
+def board_flags(board):
+	'''Return the flags of a position.'''
+	flags = 0
+	for side in (True,False):
+		if board.has_castling_rights(side):
+			flags |= RIGHTS[side]
+		if check_castling(board,side):
+			flags |= CASTLE[side]
+	if board.is_check():
+		flags |= CHECK
+	if not any(True for move in board.legal_moves):
+		flags |= CHECKMATE if flags & CHECK else STALEMATE
+	if board.turn:
+		flags |= WHITE_TURN
+	return flags
+
+### batch counts
+if np is not None:
+	POPCOUNT8 = np.array([bin(i).count('1') for i in xrange(256)],np.uint8)
+	VALUES = np.array([PIECE_VAL.get(piece_type,0) for piece_type in xrange(1,7)],np.uint8)
+
+def batch_counts(masks):
+	'''
+	returns the (N, 2, 6) piece counts, white then black, pawn to king, of
+	the bitboards of N positions given as rows of board_masks
+	'''
+	masks = np.array(masks,np.uint64).reshape(-1,12)
+	counts = POPCOUNT8[masks.view(np.uint8)].reshape(-1,12,8).sum(axis = 2,dtype = np.uint8)
+	return counts.reshape(-1,2,6)
+
+def batch_material(counts):
+	'''returns the (N, 2) white and black material of (N, 2, 6) counts'''
+	return (counts * VALUES).sum(axis = 2,dtype = np.uint8)
+
+class AttackMap(object):
+	'''Attacks of every side and piece type of a position.
+
+	covered[side][piece_type] is the bitmask of the squares attacked by the
+	pieces of that side and type, attackers[side][square] the bitmask of the
+	pieces of side attacking square.
+	'''
+	__slots__ = ['covered','attackers']
+
+	def __init__(self, board):
+		self.covered = {True : [0] * 7, False : [0] * 7}
+		self.attackers = {True : [0] * 64, False : [0] * 64}
+		for side in (True,False):
+			covered = self.covered[side]
+			attackers = self.attackers[side]
+			for piece_type in xrange(1,7):
+				pieces = board.pieces_mask(piece_type,side)
+				square = chess.bit_scan(pieces)
+				while square != -1 and square is not None:
+					mask = board.attacks_mask(square)
+					covered[piece_type] |= mask
+					target = chess.bit_scan(mask)
+					while target != -1 and target is not None:
+						attackers[target] |= chess.BB_SQUARES[square]
+						target = chess.bit_scan(mask,target + 1)
+					square = chess.bit_scan(pieces,square + 1)
+
+	def attacks(self, side, piece_type, square):
+		'''True if a piece of side and piece_type attacks square.'''
+		return bool(self.covered[side][piece_type] & chess.BB_SQUARES[square])
+
+class BoardFeatures(object):
+	'''Features of a position, computed from its board when asked.'''
+	__slots__ = ['board','attack_map']
+
+	def __init__(self, board):
+		self.board = board
+		self.attack_map = None
+
+	def attacks(self):
+		if self.attack_map is None:
+			self.attack_map = AttackMap(self.board)
+		return self.attack_map
+
+	def count(self, side, piece_type):
+		return chess.pop_count(self.board.pieces_mask(piece_type,side))
+
+	def material(self, side):
+		return calculate_material(self.board,side)
+
+	def castling_rights(self, side):
+		return self.board.has_castling_rights(side)
+
+	def can_castle(self, side):
+		return check_castling(self.board,side)
+
+	def turn(self):
+		return self.board.turn
+
+	def is_check(self):
+		return self.board.is_check()
+
+	def is_checkmate(self):
+		return self.board.is_checkmate()
+
+	def is_stalemate(self):
+		return self.board.is_stalemate()
+
+class TableFeatures(object):
+	'''Features of a position, read from row r of a FeatureTable.
+
+	Attacks are not in the table and need the position's board.
+	'''
+	__slots__ = ['table','r','board','attack_map']
+
+	def __init__(self, table, r, board = None):
+		self.table = table
+		self.r = r
+		self.board = board
+		self.attack_map = None
+
+	def attacks(self):
+		if self.attack_map is None:
+			self.attack_map = AttackMap(self.board)
+		return self.attack_map
+
+	def count(self, side, piece_type):
+		return self.table.counts[12*self.r + count_slot(side,piece_type)]
+
+	def material(self, side):
+		return self.table.material[2*self.r + (0 if side else 1)]
+
+	def castling_rights(self, side):
+		return bool(self.table.flags[self.r] & RIGHTS[side])
+
+	def can_castle(self, side):
+		return bool(self.table.flags[self.r] & CASTLE[side])
+
+	def turn(self):
+		return bool(self.table.flags[self.r] & WHITE_TURN)
+
+	def is_check(self):
+		return bool(self.table.flags[self.r] & CHECK)
+
+	def is_checkmate(self):
+		return bool(self.table.flags[self.r] & CHECKMATE)
+
+	def is_stalemate(self):
+		return bool(self.table.flags[self.r] & STALEMATE)
+
+class FeatureTable(object):
+	'''Columnar features of every position of the games of a MoveCache.
+
+	Row r describes the position after ply[r] moves of game game[r], for
+	plies 1 to the length of the game. The rows of game n are first[n] to
+	first[n+1] - 1. counts holds 12 piece counts per row, white then black,
+	pawn to king; material holds white and black material; flags holds the
+	castling, check, checkmate, stalemate and turn bits. have[n] is 0 for
+	the games no run has asked for yet, which have no rows.
+	'''
+	COLUMNS = [('game','I',1),('ply','H',1),('counts','B',12),('material','B',2),('flags','B',1)]
+
+	def __init__(self, games):
+		self.games = games
+		self.load(games.index.numbers)
+
+	def get(self, n, ply, board = None):
+		'''Return the features after ply moves of game number n.'''
+		return TableFeatures(self,self.first[n] + ply - 1,board)
+
+	def rows(self, n):
+		return xrange(self.first[n],self.first[n+1])
+
+	def key(self):
+		pgn_file = self.games.index.pgn_file
+		st = os.stat(pgn_file)
+		return "chess-qa features\t{}\t{}\t{}\t{}\n".format(FEATURES_VERSION,os.path.abspath(pgn_file),st.st_size,int(st.st_mtime))
+
+	def empty(self):
+		self.first = array('I',[0])
+		self.have = array('B')
+		for name, typecode, width in self.COLUMNS:
+			setattr(self,name,array(typecode))
+
+	def copy_game(self, table, n):
+		'''Append the rows of game number n of another table.'''
+		for name, typecode, width in self.COLUMNS:
+			getattr(self,name).extend(getattr(table,name)[width * table.first[n]:width * table.first[n+1]])
+		self.first.append(len(self.flags))
+		self.have.append(table.have[n])
+
+	def add_game(self, n, codes):
+		'''Replay game number n and append a row for each of its positions.'''
+		self.have.append(1)
+		board = chess.Board()
+		masks = []
+		for ply, code in enumerate(codes):
+			board.push(decode_move(code))
+			masks.append(board_masks(board))
+			self.game.append(n)
+			self.ply.append(ply + 1)
+			self.flags.append(board_flags(board))
+		self.first.append(len(self.flags))
+		if not masks:
+			return
+		if np is not None:
+			counts = batch_counts(masks)
+			self.counts.fromstring(counts.tostring())
+			self.material.fromstring(batch_material(counts).tostring())
+			return
+		for row in masks:
+			counts = [chess.pop_count(mask) for mask in row]
+			self.counts.extend(counts)
+			for side in (0,6):
+				self.material.append(sum(counts[side + piece_type - 1]*PIECE_VAL[piece_type] for piece_type in xrange(1,6)))
+
+	def view(self, name):
+		'''Return column name as a numpy array with a row per position.'''
+		for column, typecode, width in self.COLUMNS:
+			if column == name:
+				# numpy shares the type codes of array
+				return np.frombuffer(getattr(self,name),typecode).reshape(-1,width)
+
+	def load(self, numbers):
+		'''
+		reads <pgn file>.features, first computing the rows of the games of
+		numbers it is missing
+		'''
+		f_name = self.games.index.pgn_file + '.features'
+		key = self.key()
+		self.empty()
+		if os.path.exists(f_name):
+			with open(f_name,'rb') as f:
+				if f.readline() == key:
+					self.first = array('I')
+					self.first.fromstring(f.read(4))
+					self.first.fromfile(f,self.first[0] + 1)
+					self.first.pop(0)
+					self.have.fromfile(f,len(self.first) - 1)
+					for name, typecode, width in self.COLUMNS:
+						getattr(self,name).fromfile(f,width * self.first[-1])
+		if all(n < len(self.have) and self.have[n] for n in numbers):
+			return
+
+		# rebuild the table game by game, keeping the rows it already has
+		table = FeatureTable.__new__(FeatureTable)
+		table.first, table.have = self.first, self.have
+		for name, typecode, width in self.COLUMNS:
+			setattr(table,name,getattr(self,name))
+		self.empty()
+		games = dict((self.games.number(g),g) for g in xrange(len(self.games)))
+		n_games = max(len(table.have),max(numbers) + 1)
+		for n in xrange(n_games):
+			if n < len(table.have) and table.have[n]:
+				self.copy_game(table,n)
+			elif n in games:
+				self.add_game(n,self.games[games[n]])
+			else:
+				self.first.append(len(self.flags))
+				self.have.append(0)
+
+		# other processes may extend the same file
+		tmp_name = "{}.{}.tmp".format(f_name,os.getpid())
+		try:
+			with open(tmp_name,'wb') as f:
+				f.write(key)
+				array('I',[len(self.first) - 1]).tofile(f)
+				self.first.tofile(f)
+				self.have.tofile(f)
+				for name, typecode, width in self.COLUMNS:
+					getattr(self,name).tofile(f)
+			os.rename(tmp_name,f_name)
+		except (IOError, OSError):
+			# a read only folder, the table stays in memory
+			if os.path.exists(tmp_name):
+				os.remove(tmp_name)
+
+if __name__ == "__main__":
+	from utils import get_parser
+	from generate_qa import read_games, game_filter
+	p = get_parser().parse_args()
+	table = FeatureTable(read_games(p.pgn_file,p.n_matches,game_filter(p)))
+	print >> sys.stderr, "Total ",len(table.flags),"positions in",table.key().split('\t')[2] + '.features'
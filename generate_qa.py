@@ -7,26 +7,49 @@ answer : list of pieces, yes/no or numbers
 '''
 
 import chess, chess.pgn, os, sys, string
-import itertools,random
+import itertools,random,multiprocessing,time,cPickle,json,cProfile,pstats
 from random import shuffle
 from visualizer import *
+from pgn_index import PGNIndex, MoveCache, GameFilter, decode_move
+from output import make_writer, writer_class
+from metrics import METRICS
+from features import *
 from utils import *
 from collections import defaultdict
+from array import array
 
 ### initalize
 FIXED = 50
-PREFIX = ''
 PATH = 'output'
+WRITER = None
+FEATURES = None
+# bounds on the work spent on a q type, see --max-passes, --time-budget,
+# --patience and --underfilled
+MAX_PASSES = 0
+TIME_BUDGET = 0
+PATIENCE = 5
+UNDERFILLED = 'drop'
+# questions are unique by 'path', the moves leading to the position, or by
+# 'position', its zobrist hash, within a q type or with DEDUP_SCOPE 'all'
+# across all of them
+DEDUP = 'path'
+DEDUP_SCOPE = 'type'
+# (w, workers) : the worker asks only the questions whose dedup key falls
+# in its w-th slice, so that no two workers write the same question
+KEY_SLICE = (0,1)
+# save a checkpoint every CHECKPOINT_EVERY games walked, see --resume
+CHECKPOINT_EVERY = 1000
+RESUME = False
+# run under cProfile, see --profile
+PROFILE = False
 START = 5
 MIDDLE = 30
 END = 100
 
-ANSWERS = {}
 BOOL = {'yes' : True, 'no' : False, 'white' : True, 'black' : False}
 COLOR = {'white' : True, 'black' : False}
 INV_COLOR = { True : 'white', False : 'black'}
 POLAR = ['yes','no']
-PIECE_VAL = {1 : 1, 2 : 3 , 3: 3 , 4 : 5 , 5 : 9}
 SIDES = ['black','white']
 PIECES = ['pawn','knight','bishop','rook','queen','king']
 Zcount = [str(i) for i in xrange(1,32)]
@@ -43,6 +66,11 @@ for sq1 in ID2SQUARE:
 	for sq2 in ID2SQUARE:
 		if sq1 != sq2:
 			MOVES.append(chess.Move(sq1,sq2).uci())
+# UCI[from][to] names the move between two squares, ignoring promotions
+UCI = [["".join(ID2SQUARE[sq1])+"".join(ID2SQUARE[sq2]) for sq2 in ID2SQUARE] for sq1 in ID2SQUARE]
+# chance that an illegal move candidate is a near miss, a move the piece
+# could make if it did not leave its own king in check
+NEAR_MISS = 0.5
 
 ### question text for each q type
 def t_is_attacked(side,piece,square):
@@ -106,816 +134,1015 @@ def t_checkmate():
 	q_text = ['is this a checkmate','is the game over with a checkmate']
 	return random.choice(q_text)
 
-### util functions for boolean checks
-def check_castling(board,side):
-
-	if (chess.Move.from_uci("e1g1") in board.legal_moves and side == True) or (chess.Move.from_uci("e1c1") in board.legal_moves and side == True) or (chess.Move.from_uci("e8g8") in board.legal_moves and side == False) or (chess.Move.from_uci("e8c8") in board.legal_moves and side == False):
-		return True
-	return False
-
-def calculate_material(board,side):
-	m = 0
-	for piece in xrange(1,6):
-		m += len(list(board.pieces(piece,side)))*PIECE_VAL[piece]
-	return m
-
-### boolean check for q types
-def q_check(board,answer):
+### candidate answers for each q type
+# every g_* function looks at a single position, given as its board and
+# its features (see features.py), and yields (answer bucket, answer,
+# question text arguments) candidates, most preferred first. the engine
+# takes the first one whose bucket is open.
+def g_is_attacked(board,f):
+
+	attacked = []
+	for attacked_piece in PIECES:
+		for attacked_s in SIDES:
+			attacked_side = BOOL[attacked_s]
+			sq_list = list(board.pieces(PIECES.index(attacked_piece)+1,attacked_side))
+			for attacked_sq in sq_list:
+				attacked.append((not(attacked_side),attacked_piece,attacked_sq))
+	shuffle(attacked)
+	attackers = f.attacks().attackers
+	for (attacker_side,attacked_piece,attacked_sq) in attacked:
+		mask = attackers[attacker_side][attacked_sq]
+		if chess.pop_count(mask) != 1:
+			continue
+		attacker_piece = board.piece_type_at(chess.bit_scan(mask))
+		a = INV_COLOR[attacker_side] + PIECES[attacker_piece-1]
+		attacked_side = INV_COLOR[not(attacker_side)]
+		yield (a,attacked_side,attacked_piece), a, (attacked_side,attacked_piece,"".join(ID2SQUARE[attacked_sq]))
+
+def move_matrix(moves):
+	'''returns the to square bitmask of every from square of moves'''
+	matrix = [0] * 64
+	for m in moves:
+		matrix[m.from_square] |= chess.BB_SQUARES[m.to_square]
+	return matrix
+
+def draw_move(matrix):
+	'''
+	removes a random (from square, to square) pair from a move matrix and
+	returns its UCI, or None if the matrix is empty
+	'''
+	counts = [chess.pop_count(mask) if mask else 0 for mask in matrix]
+	k = random.randrange(sum(counts)) if any(counts) else None
+	if k is None:
+		return None
+	for from_sq, c in enumerate(counts):
+		if k < c:
+			to_sq = chess.bit_scan(matrix[from_sq])
+			for _ in xrange(k):
+				to_sq = chess.bit_scan(matrix[from_sq],to_sq + 1)
+			matrix[from_sq] ^= chess.BB_SQUARES[to_sq]
+			return UCI[from_sq][to_sq]
+		k -= c
+
+def g_legal_move(board,f):
+
+	legal = move_matrix(board.legal_moves)
+	pseudo = move_matrix(board.pseudo_legal_moves)
+	near = [pseudo[sq] & ~legal[sq] for sq in xrange(64)]
+	# any other move of any piece is illegal
+	other = [0] * 64
+	occupied = board.occupied
+	for sq in xrange(64):
+		if occupied & chess.BB_SQUARES[sq]:
+			other[sq] = chess.BB_ALL & ~chess.BB_SQUARES[sq] & ~pseudo[sq]
+
+	for a in random.sample(POLAR,2):
+		while True:
+			if a == 'yes':
+				candidate_move = draw_move(legal)
+			else:
+				pools = [near,other] if random.random() < NEAR_MISS else [other,near]
+				candidate_move = draw_move(pools[0]) or draw_move(pools[1])
+			if candidate_move is None:
+				break
+			yield (a,candidate_move), a, (candidate_move,)
+
+def g_existence(board,f):
+
+	for p in random.sample(PIECES,len(PIECES)):
+		c = 0
+		for s in SIDES:
+			c += f.count(BOOL[s],PIECES.index(p)+1)
+		a = 'no' if c == 0 else 'yes'
+		yield (a,p), a, (p,)
 
-	if BOOL[answer] == board.is_check():
-		return True
-	return False
+def g_existence_side(board,f):
 
-def q_material_count(board,side,answer):
+	for p in random.sample(PIECES,len(PIECES)):
+		for s in random.sample(SIDES,2):
+			c = f.count(BOOL[s],PIECES.index(p)+1)
+			a = 'no' if c == 0 else 'yes'
+			yield (a,p,s), a, (s,p)
 
-	count = calculate_material(board,side)
-	op_count = calculate_material(board,not(side))
-	if count - op_count == int(answer):
-		return True
-	return False
+def g_count_board(board,f):
 
-def q_material_adv(board,answer):
+	c = 0
+	for s in SIDES:
+		for piece in xrange(6):
+			c += f.count(BOOL[s],piece+1)
+	yield c, str(c), ()
+
+def g_count_all_pieces(board,f):
+
+	for s in random.sample(SIDES,2):
+		c = 0
+		for piece in xrange(6):
+			c += f.count(BOOL[s],piece+1)
+		yield (s,c), str(c), (s,)
+
+def g_position(board,f):
+
+	for s in random.sample(SIDES,2):
+		for p in random.sample(PIECES,len(PIECES)):
+			list_piece = list(board.pieces(PIECES.index(p) + 1,BOOL[s]))
+			if len(list_piece) > 1:
+				sq = ID2SQUARE[random.choice(list_piece)]
+				yield (s,p,sq), s+p, (sq,)
+
+def g_attack(board,f):
+
+	attacks = f.attacks()
+	for s in random.sample(SIDES,2):
+		for p in random.sample(PIECES[1:],len(PIECES)-1):
+			piece_type = PIECES.index(p) + 1
+			sq_list = list(chess.SquareSet(attacks.covered[BOOL[s]][piece_type]))
+			if len(sq_list) <= 0:
+				continue
 
-	w = calculate_material(board,True)
-	b = calculate_material(board,False)
-	if w == b:
+			sq = ID2SQUARE[random.choice(sq_list)]
+			yield ('yes',s,p,sq), 'yes', (s,p,sq)
+
+			square = random.choice(xrange(64))
+			if not attacks.attacks(BOOL[s],piece_type,square):
+				sq = ID2SQUARE[square]
+				yield ('no',s,p,sq), 'no', (s,p,sq)
+
+def g_check(board,f):
+
+	side = INV_COLOR[f.turn()]
+	a = 'yes' if f.is_check() else 'no'
+	yield (a,side), a, (side,)
+
+def g_material_count(board,f):
+
+	for side in random.sample(SIDES,2):
+		a = str(f.material(BOOL[side]) - f.material(not(BOOL[side])))
+		if a in Zcount:
+			yield (a,side), a, (side,)
+
+def g_material_adv(board,f):
+
+	w = f.material(True)
+	b = f.material(False)
+	if w != b:
+		a = 'white' if w > b else 'black'
+		yield a, a, ()
+
+def g_castle(board,f):
+
+	for side in random.sample(SIDES,2):
+		rights = f.castling_rights(COLOR[side])
+		if rights == f.can_castle(COLOR[side]):
+			a = 'yes' if rights else 'no'
+			yield (side,a), a, (side,)
+
+def g_castling_rights(board,f):
+
+	for side in random.sample(SIDES,2):
+		a = 'yes' if f.castling_rights(COLOR[side]) else 'no'
+		yield (side,a), a, (side,)
+
+def g_stalemate(board,f):
+
+	a = 'yes' if f.is_stalemate() else 'no'
+	yield a, a, ()
+
+def g_checkmate(board,f):
+
+	a = 'yes' if f.is_checkmate() else 'no'
+	yield a, a, ()
+
+### answer buckets and quotas
+def answer_buckets(q_type):
+
+	if q_type in (0,1):
+		return list(POLAR)
+	if q_type in (2,3):
+		return [(s,a) for s in SIDES for a in POLAR]
+	if q_type == 4:
+		return list(SIDES)
+	if q_type == 5:
+		return [(a,s) for a in Zcount for s in SIDES]
+	if q_type == 6:
+		return [(a,s) for a in POLAR for s in SIDES]
+	if q_type == 7:
+		return [(a,s,p,square) for a in POLAR for s in SIDES for p in PIECES for square in SQUARES]
+	if q_type == 8:
+		return [(s,p,square) for s in SIDES for p in PIECES for square in SQUARES]
+	if q_type == 9:
+		return [(s,c) for s in SIDES for c in xrange(1,16)]
+	if q_type == 10:
+		return range(2,32)
+	if q_type == 11:
+		return [(a,p,s) for s in SIDES for p in PIECES for a in POLAR]
+	if q_type == 12:
+		return [(a,p) for p in PIECES for a in POLAR]
+	if q_type == 13:
+		return [(a,m) for a in POLAR for m in MOVES]
+	if q_type == 14:
+		return [(a_s+a_p,s,p) for a_s in SIDES for a_p in PIECES for s in SIDES for p in PIECES]
+
+def print_buckets(buckets, most = 20):
+	'''prints a line listing at most `most` answer buckets'''
+	if buckets:
+		more = ", ... {} more".format(len(buckets) - most) if len(buckets) > most else ""
+		print >> sys.stderr, "\t" + ", ".join(buckets[:most]) + more
+
+class Quota(object):
+	'''Answer balance of one question type.
+
+	Every answer bucket may hold at most `count` questions, so that no
+	single answer dominates the generated questions. With shard = (i, n)
+	the quota is the i-th of n slices of the full one: it generates its
+	share of total_count, numbered from `offset`, and every bucket holds
+	its share of `count`. seen holds the dedup keys of the questions
+	written so far and may be shared between quotas.
+	'''
+	def __init__(self, q_type, total_count, shard = (0,1), seen = None):
+		i, n = shard
+		self.q_type = q_type
+		self.answer_count = dict((a,0) for a in ANSWERS[q_type])
+		self.count = total_count / len(self.answer_count) + SLACK[q_type]
+		# spread the remainder of count over the shards bucket by bucket
+		self.limit = {}
+		for b, a in enumerate(ANSWERS[q_type]):
+			self.limit[a] = self.count / n + (1 if (i - b) % n < self.count % n else 0)
+		self.offset = i * (total_count / n) + min(i, total_count % n)
+		self.total_count = total_count / n + (1 if i < total_count % n else 0)
+		self.total = 0
+		self.qset = set() if seen is None else seen
+		self.stopped = False
+
+	def is_open(self, a):
+		'''True if bucket a can take another question.'''
+		return self.answer_count.get(a,0) < self.limit.get(a,0)
+
+	def done(self):
+		return self.stopped or self.total >= self.total_count
+
+	def stop(self, reason):
+		'''gives up on the rest of the quota'''
+		self.stopped = True
+		print >> sys.stderr, "type {} : stopped at {}/{} questions, {}".format(self.q_type,self.total,self.total_count,reason)
+
+	def cap(self, supply):
+		'''
+		lowers the limit of every bucket to the supply of questions it can
+		hold, given by supply. buckets missing from it are unbounded.
+		'''
+		for a in self.limit:
+			self.limit[a] = min(self.limit[a],supply.get(a,self.limit[a]))
+
+	def redistribute(self, supply):
+		'''
+		caps the buckets to supply and raises the limits of the buckets with
+		supply to spare by the questions this leaves short of total_count,
+		smallest limits first. returns True if any limit was raised.
+		'''
+		self.cap(supply)
+		raised = False
+		short = self.total_count - sum(self.limit.values())
+		while short > 0:
+			spare = [a for a in ANSWERS[self.q_type] if a not in supply or self.limit[a] < supply[a]]
+			if not spare:
+				break
+			a = min(spare,key = lambda a : self.limit[a])
+			self.limit[a] += 1
+			short -= 1
+			raised = True
+		return raised
+
+	def report(self):
+		'''prints the answer buckets left below their limit'''
+		if self.total >= self.total_count:
+			return
+		short = [a for a in ANSWERS[self.q_type] if self.answer_count[a] < self.limit[a]]
+		print >> sys.stderr, "type {} : {}/{} questions, {} answer buckets short".format(self.q_type,self.total,self.total_count,len(short))
+		print_buckets(["{} : {}/{}".format(a,self.answer_count[a],self.limit[a]) for a in short])
+
+	def extend(self, base, done, keys):
+		'''
+		turns the quota into what is left of it after an earlier run of the
+		slice, done, the manifest record of its total and answer counts.
+		question numbers start from base and keys are dedup keys in use
+		'''
+		if done is not None:
+			answers = dict((str(a),a) for a in ANSWERS[self.q_type])
+			for name, c in done['answers'].iteritems():
+				a = answers[name]
+				self.limit[a] = max(0,self.limit[a] - c)
+			self.total_count = max(0,self.total_count - done['total'])
+		self.offset += base
+		self.qset.update(keys)
+
+	def summary(self):
+		'''returns what the manifest of a run records of the quota'''
+		return {'offset' : self.offset, 'total' : self.total, 'count' : self.count, 'answers' : dict((str(a),c) for a, c in self.answer_count.iteritems() if c)}
+
+	def add(self, a, key):
+		self.answer_count[a] += 1
+		self.qset.add(key)
+		self.total += 1
+
+### single pass question engine
+def ask(quota,position,key,f,bucket = None):
+	'''
+	offers the position, with dedup key `key`, to a q type. returns True if
+	a question is written. with bucket given, only a question for that
+	answer bucket is written
+	'''
+	if quota.done() or position.ply < 2:
 		return False
-	if (w > b)  == BOOL[answer]:
-		return True
-	return False
-
-def q_castle(board,side,answer):
-	if board.has_castling_rights(COLOR[side]) == BOOL[answer] and (check_castling(board,COLOR[side]) == BOOL[answer]):
-		return True
-	return False
+	board = position.board
 
-def q_castling_rights(board,side,answer):
-	if board.has_castling_rights(COLOR[side]) == BOOL[answer]:
-		return True
-	return False
-
-def q_stalemate(board, answer):
-	if board.is_stalemate() == BOOL[answer]:
-		return True
-	return False
+	q_type = quota.q_type
+	# the high bits of the path hash are the better mixed
+	if (key >> 32) % KEY_SLICE[1] != KEY_SLICE[0]:
+		return False
+	if key in quota.qset:
+		METRICS.count(('duplicates',q_type))
+		return False
 
-def q_checkmate(board, answer):
-	if board.is_checkmate() == BOOL[answer]:
-		return True
+	t = time.time()
+	METRICS.count(('predicates',q_type))
+	for a, answer, args in GENERATE[q_type](board,f):
+		if not quota.is_open(a):
+			METRICS.reject(q_type,a)
+		elif bucket in (None,a):
+			METRICS.time(('predicates',q_type),time.time() - t)
+			write_qa(position,q_type,answer,quota.offset+quota.total,QTEXT[q_type](*args))
+			quota.add(a,key)
+			METRICS.count(('questions',q_type))
+			if quota.done():
+				print >> sys.stderr, "DONE!",q_type
+			if METRICS.due():
+				progress()
+			return True
+	METRICS.time(('predicates',q_type),time.time() - t)
 	return False
 
-### generate positions for each q type
-def g_is_attacked(q_type, games, total_count):
-
-	answer_count = {}
-	total = 0
-	unique_answer = 0
-	for a_s in SIDES:
-		for a_p in PIECES:
-			for s in SIDES:
-				for p in PIECES:
-					a = a_s + a_p
-					answer_count[(a,s,p)] = 0
-					unique_answer += 1
-
-	count = total_count / unique_answer + FIXED
-	qset = set()
-	while total < total_count:
-		shuffle(games)
-		for j,game in enumerate(games):
-			moves,i,board,node = ff_game(game,START,END)
-			if i == 0:
-				continue
-
-			while node.variations:
-				next_node = node.variation(0)
-				moves.append(node.board().san(next_node.move))
-				node = next_node
-				board = node.board()
-
-				i += 1
-
-				attacked = []
-				for attacked_piece in PIECES:
-					for attacked_s in SIDES:
-						attacked_side = BOOL[attacked_s]
-						sq_list = list(board.pieces(PIECES.index(attacked_piece)+1,attacked_side))
-						for attacked_sq in sq_list:
-							attacked.append((not(attacked_side),attacked_piece,attacked_sq))
-				shuffle(attacked)
-				for (attacker_side,attacked_piece,attacked_sq) in attacked:
-					attackers = list(board.attackers(attacker_side,attacked_sq))
-
-				if len(attackers) == 0:
-					continue
-				for ind,att in enumerate(attackers):
-					attacker_piece = board.piece_type_at(attackers[ind])
-					a = INV_COLOR[attacker_side] + PIECES[attacker_piece-1]
-					attacked_side = not(attacker_side)
-
-					if len(attackers) == 1 and answer_count[(a,INV_COLOR[attacked_side],attacked_piece)] <= count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-						answer_count[(a,INV_COLOR[attacked_side],attacked_piece)] += 1
-						write_qa(board,moves,q_type,a,total, QTEXT[q_type](INV_COLOR[attacked_side],attacked_piece,"".join(ID2SQUARE[attacked_sq])))
-						total += 1
-						print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-						qset.add("".join(moves))
-						if total == total_count:
-							return
-						break
-
-def g_legal_move(q_type, games, total_count):
-
-	total = 0
-	unique_answer = 0
-	answer_count = {}
-	for a in POLAR:
-		for m in MOVES:
-			answer_count[(a,m)] = 0
-			unique_answer += 1
-
-	count = total_count / unique_answer + FIXED
-	while total < total_count:
-		shuffle(games)
-
-		for j,game in enumerate(games):
-			moves,i,board,node = ff_game(game,MIDDLE,END)
-			if i == 0:
-				continue
-
-			squares = []
-			for p in PIECES:
-				for side in SIDES:
-					s = BOOL[side]
-					squares += list(board.pieces(PIECES.index(p)+1,s))
-			a = 'yes'
-			shuffle(squares)
-
-			c_list = []
-			for from_sq in squares:
-				for to_sq in ID2SQUARE:
-					if from_sq != to_sq:
-						c_list.append("".join(ID2SQUARE[from_sq])+"".join(ID2SQUARE[to_sq]))
-			shuffle(c_list)
-
-			for candidate_move in c_list:
-				if chess.Move.from_uci(candidate_move) in board.legal_moves and answer_count[(a,candidate_move)] < count and len(moves) > 0 and total < total_count :
-					answer_count[(a,candidate_move)] += 1
-					write_qa(board,moves,q_type,a,total, QTEXT[q_type](candidate_move))
-					total += 1
-					print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-					if total == total_count:
-						return
-
-
-			moves,i,board,node = ff_game(node,START,MIDDLE)
-			a = 'no'
-
-			c_list = []
-			for from_sq in squares:
-				for to_sq in ID2SQUARE:
-					if from_sq != to_sq:
-						c_list.append("".join(ID2SQUARE[from_sq])+"".join(ID2SQUARE[to_sq]))
-			shuffle(c_list)
-			for candidate_move in c_list:
-				if chess.Move.from_uci(candidate_move) not in board.legal_moves and answer_count[(a,candidate_move)] < count and len(moves) > 2 and total < total_count :
-					answer_count[('no',candidate_move)] += 1
-					write_qa(board,moves,q_type,a,total, QTEXT[q_type](candidate_move))
-					total += 1
-					print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-					if total == total_count:
-						return
-
-
-def g_existence(q_type, games, total_count):
-
-	answer_count = {}
-	total = 0
-	unique_answer = 0
-
-	for p in PIECES:
-		for a in POLAR:
-			answer_count[(a,p)] = 0
-			unique_answer += 1
-
-	count = total_count / unique_answer + 10
-	qset = set()
-	while total <  total_count:
-		shuffle(games)
-
-		for p in PIECES:
-			for j,game in enumerate(games):
-				moves,i,board,node = ff_game(game,START,START+5)
-				if i == 0:
-					continue
-
-				while node.variations:
-					next_node = node.variation(0)
-					moves.append(node.board().san(next_node.move))
-					node = next_node
-					board = node.board()
-
-					i += 1
-
-					c = 0
-					for s in SIDES:
-						side = BOOL[s]
-						c += len(list(board.pieces(PIECES.index(p)+1,side)))
-
-					a = 'no' if c == 0 else 'yes'
-					if answer_count[(a,p)] < count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-						answer_count[(a,p)] += 1
-						write_qa(board,moves,q_type,a,total, QTEXT[q_type](p))
-						total += 1
-						print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-						qset.add("".join(moves))
-						if total == total_count:
-							return
-						break
-
-
-def g_existence_side(q_type, games, total_count):
-
-	answer_count = {}
-	total = 0
-	unique_answer = 0
-
-	for s in SIDES:
-		for p in PIECES:
-			for a in POLAR:
-				answer_count[(a,p,s)] = 0
-				unique_answer += 1
-	count = total_count / unique_answer + FIXED
-	qset = set()
-	while total < total_count:
-		shuffle(games)
-
-		for p in PIECES:
-			for s in SIDES:
-				for j,game in enumerate(games):
-
-					moves,i,board,node = ff_game(game,START,END)
-					if i == 0:
-						continue
-
-					while node.variations:
-						next_node = node.variation(0)
-						moves.append(node.board().san(next_node.move))
-						node = next_node
-						board = node.board()
-						i += 1
-
-
-						side = BOOL[s]
-						c = len(list(board.pieces(PIECES.index(p)+1,side)))
-						a = 'no' if c == 0 else 'yes'
- 						if answer_count[(a,p,s)] < count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-							answer_count[(a,p,s)] += 1
-							write_qa(board,moves,q_type,a,total,QTEXT[q_type](s,p))
-							total += 1
-							print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-							qset.add("".join(moves))
-							if total == total_count:
-								return
-							break
-
-def g_count_board(q_type, games, total_count):
-
-	answer_count = defaultdict(lambda: total_count)
-	total = 0
-	unique_answer = 0
-
-	for c in xrange(2,32):
-		answer_count[c] = 0
-		unique_answer += 1
-
-	count = total_count / unique_answer + FIXED
-	qset = set()
-	while total < total_count:
-
-		shuffle(games)
-
-		for j,game in enumerate(games):
-
-			moves,i,board,node = ff_game(game,START,END)
-			if i == 0:
+def play(game,n,quotas):
+	'''
+	walks game number n once, offering each position to every q type whose
+	window covers it.
+	'''
+	windows = []
+	for quota in quotas:
+		for start, end, mode in WINDOW[quota.q_type]:
+			# final mates and stalemates are mined from the move cache instead
+			if mode == 'last' and quota.q_type in TERMINAL:
 				continue
-
-			while node.variations:
-				next_node = node.variation(0)
-				moves.append(node.board().san(next_node.move))
-				node = next_node
-				board = node.board()
-				i += 1
-
-				c = 0
-				for s in SIDES:
-					side = BOOL[s]
-					for piece in xrange(6):
-						c += len(list(board.pieces(piece+1,side)))
-
-				if answer_count[c] < count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-					answer_count[c] += 1
-					write_qa(board,moves,q_type,str(c),total, QTEXT[q_type]())
-					total += 1
-					print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-
-					qset.add("".join(moves))
-					if total == total_count:
-						return
-					break
-
-
-def g_count_all_pieces(q_type, games, total_count):
-
-	total = 0
-	unique_answer = 0
-
-	answer_count = defaultdict(lambda: total_count)
-	for s in SIDES:
-		for c in xrange(1,16):
-			answer_count[(s,c)] = 0
-			unique_answer += 1
-	count = total_count / unique_answer + FIXED
-	qset = set()
-	while total < total_count:
-		shuffle(games)
-		for s in SIDES:
-			for j,game in enumerate(games):
-				moves,i,board,node = ff_game(game,START,END)
-
-				side = BOOL[s]
-				while node.variations:
-					next_node = node.variation(0)
-					moves.append(node.board().san(next_node.move))
-					node = next_node
-					board = node.board()
-					i += 1
-					c = 0
-					for piece in xrange(6):
-						c += len(list(board.pieces(piece+1,side)))
-
-					if answer_count[(s,c)] < count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-						answer_count[(s,c)] += 1
-						write_qa(board,moves,q_type,str(c),total, QTEXT[q_type](s))
-						total += 1
-						print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-						qset.add("".join(moves))
-						if total == total_count:
-							return
-						break
-
-
-def g_position(q_type, games, total_count):
-
-	answer_count = {}
-	total = 0
-	unique_answer = 0
-	for s in SIDES:
-		for p in PIECES:
-			for square in SQUARES:
-				answer_count[(s,p,square)] = 0
-				unique_answer += 1
-	count = total_count / unique_answer + FIXED
-	qset = set()
-	while total < total_count:
-		shuffle(games)
-		for s in SIDES:
-			for p in PIECES:
-				for j,game in enumerate(games):
-					moves,i,board,node = ff_game(game,START,END)
-					if i == 0:
-						continue
-
-					while node.variations:
-						next_node = node.variation(0)
-						moves.append(node.board().san(next_node.move))
-						node = next_node
-						board = node.board()
-
-						i += 1
-
-						side = BOOL[s]
-						list_piece = list( board.pieces(PIECES.index(p) + 1,side))
-						if len(list_piece) > 1:
-							square = random.choice(list_piece)
-							sq = ID2SQUARE[square]
-							if answer_count[s,p,sq] < count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-								answer_count[(s,p,sq)] += 1
-								write_qa(board,moves,q_type,s+p,total, QTEXT[q_type](sq))
-								total += 1
-								print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-								qset.add("".join(moves))
-								if total == total_count:
-									return
-								break
-
-def g_attack(q_type, games, total_count):
-
-	answer_count = {}
-	total = 0
-	unique_answer = 0
-	for a in POLAR:
-		for s in SIDES:
-			for p in PIECES:
-				for square in SQUARES:
-					answer_count[(a,s,p,square)] = 0
-					unique_answer += 1
-	count = total_count / unique_answer + FIXED
-	qset = set()
-	while total < total_count:
-
-		shuffle(games)
-
-		for s in SIDES:
-			for p in PIECES[1:]:
-				for j,game in enumerate(games):
-					moves,i,board,node = ff_game(game,START,END)
-					if i == 0:
+			windows.append((quota, mode, random.randint(start,end)))
+
+	position = Position(game)
+	for board in replay(position):
+		i = position.ply
+		key = dedup_key(position)
+		f = BoardFeatures(board) if FEATURES is None else FEATURES.get(n,i,board)
+		for w in list(windows):
+			quota, mode, ply = w
+			if mode == 'walk' and i > ply:
+				if ask(quota,position,key,f) or quota.done():
+					windows.remove(w)
+			elif mode == 'ply' and i == ply:
+				ask(quota,position,key,f)
+				windows.remove(w)
+		if not windows:
+			break
+	else:
+		# game ended before reaching some windows. 'ply' windows fall
+		# back to the final position, like a fast-forward past the end
+		i = position.ply
+		for quota, mode, ply in windows:
+			if i > 0 and (mode == 'last' or (mode == 'ply' and ply > i)):
+				ask(quota,position,key,f)
+
+def generate(q_types, games, total_count, shard = (0,1), name = 'qa', state = None, extend = None):
+	'''
+	generates total_count questions for each of q_types, visiting every
+	position of a game once for all types. checkpoints are saved as name,
+	and with state, the run continues from a loaded checkpoint. with
+	extend, see extension(), only the questions an earlier run left to
+	total_count are generated
+	'''
+	if state is None:
+		seen = set() if DEDUP_SCOPE == 'all' else None
+		quotas = [Quota(q_type,total_count,shard,seen) for q_type in q_types]
+		if extend is not None:
+			for quota in quotas:
+				keys = extend['keys'].get('all' if DEDUP_SCOPE == 'all' else str(quota.q_type),[])
+				quota.extend(extend['base'],extend['types'].get(str(quota.q_type)),keys)
+		preflight(quotas,games)
+		state = {'quotas' : quotas, 'phase' : 'draw'}
+		save_checkpoint(name,state)
+	else:
+		random.setstate(state['random'])
+	quotas = state['quotas']
+	walking = quotas
+	if FEATURES is not None:
+		walking = [quota for quota in quotas if quota.q_type not in INDEXED]
+	if state['phase'] == 'draw' and FEATURES is not None:
+		t = time.time()
+		indexed = [quota for quota in quotas if quota.q_type in INDEXED]
+		index = BucketIndex(FEATURES,games,[quota.q_type for quota in indexed])
+		index.report(indexed)
+		METRICS.time('index',time.time() - t)
+		if UNDERFILLED == 'redistribute':
+			for quota in indexed:
+				quota.redistribute(dict((a,index.supply(quota.q_type,a)) for a in ANSWERS[quota.q_type]))
+		t = time.time()
+		draw(indexed,games,index)
+		METRICS.time('draw',time.time() - t)
+	if state['phase'] == 'draw':
+		t = time.time()
+		mine(walking,games)
+		METRICS.time('mine',time.time() - t)
+		state.update({'phase' : 'walk', 'order' : range(len(games)), 'at' : None, 'passes' : 0, 'elapsed' : 0.0, 'stalled' : dict((quota.q_type,0) for quota in walking)})
+		save_checkpoint(name,state)
+
+	t = time.time()
+	walk(walking,games,state,name)
+	METRICS.time('walk',time.time() - t)
+	for quota in quotas:
+		quota.report()
+	progress()
+	return quotas
+
+def progress():
+	'''prints a progress line with the metrics of the run so far'''
+	totals = defaultdict(int)
+	for name, n in METRICS.counters.items():
+		totals[name[0] if isinstance(name,tuple) else name] += n
+	elapsed = time.time() - METRICS.start
+	METRICS.progress("{} questions, {:.1f} questions/s, {} positions replayed, {} predicates evaluated, {} answers rejected by full buckets, {} images rendered, {} bytes written".format(totals['questions'],totals['questions'] / elapsed if elapsed > 0 else 0.0,totals['positions'],totals['predicates'],sum(METRICS.rejected.itervalues()),totals['renders'],totals['bytes']))
+
+def walk(quotas, games, state, name):
+	'''
+	plays the games over and over, in a new random order every pass, until
+	the quotas are done or out of budget
+	'''
+	start = time.time() - state['elapsed']
+	order = state['order']
+	while True:
+		if state['at'] is None:
+			remaining = [quota for quota in quotas if not quota.done()]
+			if not remaining:
+				break
+			state['before'] = dict((quota.q_type,quota.total) for quota in remaining)
+			shuffle(order)
+			state['at'] = 0
+		while state['at'] < len(order):
+			remaining = [quota for quota in quotas if not quota.done()]
+			if not remaining or (TIME_BUDGET and time.time() - start >= TIME_BUDGET):
+				break
+			g = order[state['at']]
+			state['at'] += 1
+			play(games[g],games.number(g),remaining)
+			if METRICS.due():
+				progress()
+			if CHECKPOINT_EVERY and state['at'] % CHECKPOINT_EVERY == 0:
+				state['elapsed'] = time.time() - start
+				save_checkpoint(name,state)
+		state['at'] = None
+		state['passes'] += 1
+		check_budget(quotas,state['before'],state['stalled'],state['passes'],time.time() - start)
+
+def check_budget(quotas, before, stalled, passes, elapsed):
+	'''
+	after a pass over the games, stops the q types that ran out of passes,
+	time or positions. a q type without a new question for PATIENCE passes
+	has exhausted its open answer buckets, which are dropped, or with
+	--underfilled redistribute, handed over to the other buckets.
+	'''
+	for quota in quotas:
+		if quota.done():
+			continue
+		if not any(quota.is_open(a) for a in ANSWERS[quota.q_type]):
+			quota.stop("all answer buckets full")
+			continue
+		if MAX_PASSES and passes >= MAX_PASSES:
+			quota.stop("out of passes")
+			continue
+		if TIME_BUDGET and elapsed >= TIME_BUDGET:
+			quota.stop("out of time")
+			continue
+		stalled[quota.q_type] = stalled[quota.q_type] + 1 if quota.total == before[quota.q_type] else 0
+		if stalled[quota.q_type] < PATIENCE:
+			continue
+		supply = dict((a,quota.answer_count[a]) for a in ANSWERS[quota.q_type] if quota.is_open(a))
+		if UNDERFILLED == 'redistribute' and quota.redistribute(supply):
+			stalled[quota.q_type] = 0
+		else:
+			quota.stop("no new question in {} passes".format(PATIENCE))
+
+def preflight(quotas, games):
+	'''
+	prints the q types that cannot be filled even if every position in
+	their window gave a question
+	'''
+	lengths = defaultdict(int)
+	for g in xrange(len(games)):
+		lengths[len(games[g])] += 1
+	for quota in quotas:
+		supply = sum(n for length, n in lengths.iteritems() for ply in xrange(1,length + 1) if in_window(quota.q_type,ply,length)) / KEY_SLICE[1]
+		if supply < quota.total_count:
+			print >> sys.stderr, "type {} : only {} positions in its window for {} questions".format(quota.q_type,supply,quota.total_count)
+
+def mine(quotas, games):
+	'''
+	answers 'yes' for the q types of TERMINAL from the final positions of
+	the games the move cache classifies as such, replaying no other game.
+	a bucket left open has no position to spare and is capped, or with
+	--underfilled redistribute, handed over to the other buckets.
+	'''
+	for quota in quotas:
+		if quota.q_type not in TERMINAL:
+			continue
+		order = [g for g in xrange(len(games)) if games.terminal(g) == TERMINAL[quota.q_type]]
+		shuffle(order)
+		for g in order:
+			if quota.done() or not quota.is_open('yes'):
+				break
+			position = Position(games[g])
+			for board in replay(position):
+				pass
+			if position.ply:
+				f = BoardFeatures(board) if FEATURES is None else FEATURES.get(games.number(g),position.ply,board)
+				ask(quota,position,dedup_key(position),f,'yes')
+		if quota.is_open('yes'):
+			print >> sys.stderr, "type {} : {} games end in {}".format(quota.q_type,len(order),TERMINAL[quota.q_type])
+			supply = {'yes' : quota.answer_count['yes']}
+			if UNDERFILLED == 'redistribute':
+				quota.redistribute(supply)
+			else:
+				quota.cap(supply)
+
+### answer bucket index
+def in_window(q_type, ply, length):
+	'''
+	True if play can offer the position after ply moves of a game of length
+	plies to q_type. ply and length may also be numpy arrays
+	'''
+	covered = False
+	for start, end, mode in WINDOW[q_type]:
+		if mode == 'walk':
+			covered = covered | (ply > start)
+		elif mode == 'ply':
+			covered = covered | ((start <= ply) & (ply <= end)) | ((ply == length) & (length < end))
+		elif mode == 'last':
+			covered = covered | (ply == length)
+	return covered & (ply >= 2)
+
+### answer buckets of many positions at once
+# every b_* function takes the (N, 2, 6) piece counts, white then black,
+# and (N, 2) material of N positions and yields each answer bucket of its
+# q type with the mask of the positions in it, like the g_* function of
+# the q type would place them
+SIDE_AXIS = {'white' : 0, 'black' : 1}
+
+def b_material_adv(counts, material):
+
+	w = material[:,0]
+	b = material[:,1]
+	yield 'white', w > b
+	yield 'black', w < b
+
+def b_material_count(counts, material):
+
+	for side in SIDES:
+		diff = material[:,SIDE_AXIS[side]].astype(np.int16) - material[:,1 - SIDE_AXIS[side]]
+		for a in Zcount:
+			yield (a,side), diff == int(a)
+
+def b_count_all_pieces(counts, material):
+
+	sums = counts.sum(axis = 2)
+	for s, c in ANSWERS[9]:
+		yield (s,c), sums[:,SIDE_AXIS[s]] == c
+
+def b_count_board(counts, material):
+
+	sums = counts.sum(axis = (1,2))
+	for c in ANSWERS[10]:
+		yield c, sums == c
+
+def b_existence_side(counts, material):
+
+	for a, p, s in ANSWERS[11]:
+		yield (a,p,s), (counts[:,SIDE_AXIS[s],PIECES.index(p)] > 0) == BOOL[a]
+
+def b_existence(counts, material):
+
+	sums = counts.sum(axis = 1)
+	for a, p in ANSWERS[12]:
+		yield (a,p), (sums[:,PIECES.index(p)] > 0) == BOOL[a]
+
+class BucketIndex(object):
+	'''Posting lists of the positions in every answer bucket.
+
+	postings[q_type][a] holds the FeatureTable rows of the positions of
+	games that q_type would accept in its window with answer bucket a.
+	Only q types whose buckets follow from the feature table (INDEXED)
+	can be indexed.
+	'''
+	def __init__(self, table, games, q_types):
+		self.table = table
+		self.postings = dict((q_type,dict((a,array('I')) for a in ANSWERS[q_type])) for q_type in q_types)
+		if np is not None:
+			self.batch(games,[q_type for q_type in q_types if q_type in BATCH])
+			q_types = [q_type for q_type in q_types if q_type not in BATCH]
+		if not q_types:
+			return
+
+		# the extractors shuffle their candidates, which must not change
+		# the random stream of the run
+		state = random.getstate()
+		for g in xrange(len(games)):
+			rows = table.rows(games.number(g))
+			for r in rows:
+				f = TableFeatures(table,r)
+				for q_type in q_types:
+					if not in_window(q_type,table.ply[r],len(rows)):
 						continue
-
-					while node.variations:
-						next_node = node.variation(0)
-						moves.append(node.board().san(next_node.move))
-						node = next_node
-						board = node.board()
-						i += 1
-
-
-						side = BOOL[s]
-						list_piece = list( board.pieces(PIECES.index(p) + 1,side))
-						if len(list_piece) <= 0:
-							continue
-
-						piece = random.choice(list_piece)
-						sq_list = list(board.attacks(piece))
-						if len(sq_list) <= 0:
-							continue
-						square = random.choice(sq_list)
-
-						sq = ID2SQUARE[square]
-						a = 'yes'
-						if answer_count[a,s,p,sq] < count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-							sq = ID2SQUARE[square]
-							answer_count[(a,s,p,sq)] += 1
-							write_qa(board,moves,q_type,a,total, QTEXT[q_type](s,p,sq))
-							total += 1
-							print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-
-							qset.add("".join(moves))
-							if total == total_count:
-								return
-							break
-
-						square = random.choice(xrange(64))
-						a = 'no'
-						if square not in set(sq_list) and answer_count[a,s,p,sq] < count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-							sq = ID2SQUARE[square]
-							answer_count[(a,s,p,sq)] += 1
-							write_qa(board,moves,q_type,a,total, QTEXT[q_type](s,p,sq))
-							total += 1
-							print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-							qset.add("".join(moves))
-							if total == total_count:
-								return
-							break
-
-def g_check(q_type, games, total_count):
-
-	answer_count = {}
-	unique_answer = 0
-	total = 0
-	for a in POLAR:
-		for s in SIDES:
-			answer_count[(a,s)] = 0
-			unique_answer += 1
-	count = total_count / unique_answer + 1
-
-	qset = set()
-	while total < total_count:
-		shuffle(games)
-		for side in SIDES:
-			for j,game in enumerate(games):
-				moves,i,board,node = ff_game(game,MIDDLE, END)
-				if i == 0:
-					continue
-
-				while node.variations:
-					next_node = node.variation(0)
-					moves.append(node.board().san(next_node.move))
-					node = next_node
-					board = node.board()
-					i += 1
-
-					answer = 'no'
-					turn  = False
-					if i%2 == 0:
-						turn = True
-
-					if q_check(board,answer) and BOOL[side] == turn and answer_count[(answer,side)] < count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-						answer_count[(answer,side)] += 1
-						write_qa(board,moves,q_type,answer,total, QTEXT[q_type](side))
-						total += 1
-						print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-						qset.add("".join(moves))
-						if total == total_count:
-							return
+					postings = self.postings[q_type]
+					for a, answer, args in GENERATE[q_type](None,f):
+						if a in postings:
+							postings[a].append(r)
+		random.setstate(state)
+
+	def batch(self, games, q_types):
+		'''indexes q_types with their b_* functions'''
+		table = self.table
+		first = np.frombuffer(table.first,np.uint32)
+		numbers = [games.number(g) for g in xrange(len(games))]
+		rows = np.concatenate([np.arange(first[n],first[n+1],dtype = np.uint32) for n in numbers] or [np.zeros(0,np.uint32)])
+		ply = table.view('ply')[rows,0]
+		game = table.view('game')[rows,0]
+		length = first[game + 1] - first[game]
+		counts = table.view('counts')[rows].reshape(-1,2,6)
+		material = table.view('material')[rows]
+		for q_type in q_types:
+			covered = in_window(q_type,ply,length)
+			postings = self.postings[q_type]
+			for a, mask in BATCH[q_type](counts,material):
+				postings[a].fromstring(rows[covered & mask].tostring())
+
+	def supply(self, q_type, a):
+		return len(self.postings[q_type][a])
+
+	def report(self, quotas):
+		'''prints the supply of positions of every answer bucket'''
+		for quota in quotas:
+			q_type = quota.q_type
+			short = [a for a in ANSWERS[q_type] if self.supply(q_type,a) < quota.limit[a]]
+			print >> sys.stderr, "type {} : {} positions in {} answer buckets, {} below their limit".format(q_type,sum(self.supply(q_type,a) for a in ANSWERS[q_type]),len(ANSWERS[q_type]),len(short))
+			print_buckets(["{} : {}/{}".format(a,self.supply(q_type,a),quota.limit[a]) for a in short])
+
+def draw(quotas, games, index):
+	'''
+	fills quotas from the posting lists of their open answer buckets. every
+	round draws the positions still needed round robin over the buckets and
+	replays each game with a drawn position once.
+	'''
+	table = index.table
+	number = dict((games.number(g),g) for g in xrange(len(games)))
+	pending = {}
+	for quota in quotas:
+		for a in ANSWERS[quota.q_type]:
+			rows = list(index.postings[quota.q_type][a])
+			shuffle(rows)
+			pending[quota.q_type,a] = rows
+
+	while True:
+		picks = defaultdict(list)
+		for quota in quotas:
+			need = quota.total_count - quota.total
+			room = dict((a,quota.limit[a] - quota.answer_count[a]) for a in ANSWERS[quota.q_type])
+			buckets = [a for a in ANSWERS[quota.q_type] if room[a] > 0 and pending[quota.q_type,a]]
+			shuffle(buckets)
+			while need > 0 and buckets:
+				for a in list(buckets):
+					if need == 0:
 						break
-
-					answer = 'yes'
-					if q_check(board,answer) and BOOL[side] == turn and answer_count[(answer,side)] < count and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-						answer_count[(answer,side)] += 1
-						write_qa(board,moves,q_type,answer,total, QTEXT[q_type](side))
-						total += 1
-						print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-						qset.add("".join(moves))
-						if total == total_count:
-							return
-						break
-def g_material_count(q_type, games, total_count):
-
-	answer_count = {}
-	unique_answer = 0
-	total = 0
-	for a in Zcount:
-		for s in SIDES:
-			answer_count[(a,s)] = 0
-			unique_answer +=1
-	count = total_count / unique_answer + FIXED
-
-	qset = set()
-	while total <  total_count:
-		shuffle(games)
-		for answer in Zcount:
-			for side in SIDES:
-				for j,game in enumerate(games):
-					if answer_count[(answer,side)] >= count:
-						break
-					moves,i,board,node = ff_game(game,START,END)
-					if i == 0:
-						continue
-
-					k = 0
-					while node.variations:
-						next_node = node.variation(0)
-						moves.append(node.board().san(next_node.move))
-						node = next_node
-						board = node.board()
-
-						k += 1
-						i += 1
-
-						if q_material_count(board,BOOL[side],answer) and len(moves) > 1 and total < total_count and "".join(moves) not in qset:
-							answer_count[(answer,side)] += 1
-							write_qa(board,moves,q_type,answer,total, QTEXT[q_type](side))
-							qset.add("".join(moves))
-							total += 1
-							print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-							if total == total_count:
-								return
-							break
-
-
-def g_material_adv(q_type, games, total_count):
-
-	answer_count = { 'white' : 0, 'black' : 0}
-	total = 0
-	unique_answer = 2
-	count = total_count / unique_answer + 1
-	while total < total_count:
-		shuffle(games)
-
-		for answer in SIDES:
-			for j,game in enumerate(games):
-				if answer_count[answer] >= count:
+					rows = pending[quota.q_type,a]
+					r = rows.pop()
+					picks[table.game[r]].append((table.ply[r],quota,a))
+					need -= 1
+					room[a] -= 1
+					if room[a] == 0 or not rows:
+						buckets.remove(a)
+		if not picks:
+			return
+
+		for n in sorted(picks):
+			at = defaultdict(list)
+			for ply, quota, a in picks[n]:
+				at[ply].append((quota,a))
+			position = Position(games[number[n]])
+			for board in replay(position):
+				for quota, a in at.pop(position.ply,[]):
+					ask(quota,position,dedup_key(position),table.get(n,position.ply,board),a)
+				if not at:
 					break
-				moves,i,board,node = ff_game(game,START,MIDDLE)
-				if i == 0:
-					continue
-
-				if q_material_adv(board,answer) and len(moves) > 1 and total < total_count:
-					answer_count[answer] += 1
-					write_qa(board,moves,q_type,answer,total, QTEXT[q_type]())
-					total += 1
-					print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-					if total == total_count:
-						return
-
-
-def g_castle(q_type, games, total_count):
-
-	answer_count = { ('white','yes') : 0, ('black','yes') : 0, ('white','no') : 0, ('black','no') : 0}
-	total = 0
-	unique_answer = 4
-	count = total_count / unique_answer + 1
-	while total < total_count:
-		shuffle(games)
-
-		for side in SIDES:
-			for answer in POLAR:
-				for j,game in enumerate(games):
-					if answer_count[(side,answer)] >= count:
-						break
-
-					moves,i,board,node = ff_game(game,START,MIDDLE)
-					if i == 0:
-						continue
-
-					if q_castle(board,side,answer) and len(moves) > 1 and total < total_count:
-						answer_count[(side,answer)] += 1
-						write_qa(board,moves,q_type,answer,total, QTEXT[q_type](side))
-						total += 1
-						print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-						if total == total_count:
-							return
-
-
-def g_castling_rights(q_type, games, total_count):
-
-	answer_count = { ('white','yes') : 0, ('black','yes') : 0, ('white','no') : 0, ('black','no') : 0}
-	total = 0
-	unique_answer = 4
-	count = total_count / unique_answer + 1 + 1
-	while total < total_count:
-		shuffle(games)
-		for side in SIDES:
-			for answer in POLAR:
-				for j,game in enumerate(games):
-					if answer_count[(side,answer)] >= count:
-						break
-
-					moves,i,board,node = ff_game(game,START,MIDDLE)
-					if i == 0:
-						continue
-					if q_castling_rights(board,side,answer) and len(moves) > 1 and total < total_count:
-						answer_count[(side,answer)] += 1
-						write_qa(board,moves,q_type,answer,total, QTEXT[q_type](side))
-						total += 1
-						print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-						if total == total_count:
-							return
-
-
-def g_stalemate(q_type, games, total_count):
-
-	answer_count = {'yes' : 0, 'no' : 0}
-	total = 0
-	unique_answer = 2
-	count = total_count / unique_answer + 1 
-	while total < total_count:
-
-		shuffle(games)
-		for j,game in enumerate(games):
-
-			moves,i,board,node = ff_game(game,MIDDLE,END)
-			if i == 0:
-				continue
-
-			answer = 'no'
-			if q_stalemate(board,answer) and answer_count[answer] < count and len(moves) > 1 and total < total_count:
-				answer_count[answer] += 1
-				write_qa(board,moves,q_type,answer,total,QTEXT[q_type]())
-				total += 1
-				print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-				if total == total_count:
-					return
-
-
-			k = 0
-			while node.variations:
-				next_node = node.variation(0)
-				moves.append(node.board().san(next_node.move))
-				node = next_node
-				k += 1
-				i += 1
-
-			if k == 0:
-				continue
 
-			node = next_node
-			board = node.board()
-			answer = 'yes'
-
-			if q_stalemate(board,answer) and answer_count[answer] < count and len(moves) > 1 and total < total_count:
-				answer_count[answer] += 1
-				write_qa(board,moves,q_type,answer,total,QTEXT[q_type]())
-				total += 1
-				print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-				if total == total_count:
-					return
-
-
-def g_checkmate(q_type, games, total_count):
-
-	answer_count = {'yes' : 0, 'no' : 0}
-	total = 0
-	unique_answer = 2
-	count = total_count / unique_answer  + 1
-
-	qset = set()
-	while total < total_count:
-		shuffle(games)
-		for j,game in enumerate(games):
-			moves,i,board,node = ff_game(game,MIDDLE,END)
-
-			if i == 0:
-				continue
-
-			if q_checkmate(board,'no') and answer_count['no'] < count and len(moves) > 1 and total < total_count:
-				answer_count['no'] += 1
-				write_qa(board,moves,q_type,'no',total,QTEXT[q_type]())
-				total += 1
-				print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-				if total == total_count:
-					return
-
-
-			k = 0
-			while node.variations:
-				next_node = node.variation(0)
-				moves.append(node.board().san(next_node.move))
-				node = next_node
-				k += 1
-				i += 1
-
-			if k == 0:
-				continue
-
-			node = next_node
-			board = node.board()
-
-			if q_checkmate(board,'yes') and answer_count['yes'] < count and len(moves) > 1 and total < total_count:
-				answer_count['yes'] += 1
-				write_qa(board,moves,q_type,'yes',total,QTEXT[q_type]())
-				total += 1
-				print "{}/{} generated for type {}. answer type per question {}".format(total,total_count,q_type, unique_answer)
-				if total == total_count:
-					return
-
-
-### fast-forward game for a number of steps
-def ff_game(game,start,end):
-
-	moves = []
-	node = game
-	nmoves = random.randint(start,end)
-
-	i = 0
-	while node.variations:
-		i += 1
-		next_node = node.variation(0)
-		board = node.board()
-		moves.append(node.board().san(next_node.move))
-		node = next_node
-		if i == nmoves:
-			break
-
-	board = node.board()
-	if i == 0:
-		return moves,0,board,node
-	node = next_node
-	return moves,i,board,node
-
-### write question data into files
-def write_qa(board,m,q,a,c, q_text, meta = ''):
-
-	fen = board.fen()
-	renderer = DrawChessPosition()
-	board_image = renderer.draw(fen)
-
-	f_name = "q"+str(q)+"_"+str(c)
-	board_image.save(PREFIX+f_name+'.png')
-
-	moves = " ".join(m)
+### checkpoints
+def checkpoint_file(name):
+	return os.path.join(PATH,name+'.checkpoint')
+
+def save_checkpoint(name, state):
+	'''
+	saves the engine state with the RNG and writer state, once everything
+	written so far is on disk
+	'''
+	if not CHECKPOINT_EVERY:
+		return
+	state['writer'] = WRITER.checkpoint()
+	state['random'] = random.getstate()
+	f_name = checkpoint_file(name)
+	with open(f_name+'.tmp','wb') as f:
+		cPickle.dump(state,f,cPickle.HIGHEST_PROTOCOL)
+	os.rename(f_name+'.tmp',f_name)
+
+def load_checkpoint(name):
+	with open(checkpoint_file(name),'rb') as f:
+		return cPickle.load(f)
+
+### parallel generation
+def init_worker(games, options):
+	global GAMES, OPTIONS
+	GAMES = games
+	OPTIONS = options
+
+def run_worker(job):
+	'''
+	runs the engine on the games with its own RNG stream and output
+	shards, asking only the questions of the w-th slice of the dedup keys.
+	games shared by the workers may share their opening moves, splitting
+	the keys keeps the questions unique across workers. the slices of all
+	workers of all shards of a build number their questions apart
+	'''
+	global WRITER, KEY_SLICE
+	w, workers, q_types, total_count, seed, shard, name, previous = job
+	i, n = shard
+	s = i * workers + w
+	KEY_SLICE = (w,workers)
+	random.seed(seed * 1000003 + s)
+	name = name+'-w'+str(w)
+	METRICS.setup(OPTIONS.progress_every,metrics_file(OPTIONS.metrics_file,name),name)
+	state = load_checkpoint(name) if RESUME else None
+	WRITER = make_writer(OPTIONS,name,state['writer'] if state else None)
+	quotas = profiled(name,generate,q_types,GAMES,total_count,(s,n * workers),name,state,extension(previous,s))
+	WRITER.close()
+	return run_record(s,name,quotas)
+
+def generate_parallel(q_types, games, total_count, workers, seed, options, shard = (0,1), name = 'qa', previous = None):
+	'''
+	splits the games and every quota among a pool of worker processes and
+	merges their answer counts. returns the run_record of every worker
+	'''
+	pool = multiprocessing.Pool(workers,init_worker,(games,options))
+	jobs = [(w,workers,q_types,total_count,seed,shard,name,previous) for w in xrange(workers)]
+	runs = pool.map(run_worker,jobs)
+	pool.close()
+	pool.join()
+
+	for q_type, counts in sorted(merge_answers(runs).iteritems()):
+		count = total_count / len(ANSWERS[q_type]) + SLACK[q_type]
+		print >> sys.stderr, "type {} : {} questions from {} workers, largest answer bucket {} (serial limit {})".format(q_type,sum(counts.values()),workers,max(counts.values() or [0]),count)
+	return runs
+
+### metrics and profiles
+def metrics_file(f_name, name):
+	'''returns the metrics file of the run or worker saving as name'''
+	if f_name is None or name == 'qa':
+		return f_name
+	base, ext = os.path.splitext(f_name)
+	return base+'-'+name+ext
+
+def profiled(name, function, *args):
+	'''
+	calls function, with --profile under cProfile, saving the stats to
+	PATH/<name>.prof and printing the functions most time is spent in
+	'''
+	if not PROFILE:
+		return function(*args)
+	profiler = cProfile.Profile()
+	try:
+		return profiler.runcall(function,*args)
+	finally:
+		profiler.dump_stats(os.path.join(PATH,name+'.prof'))
+		pstats.Stats(profiler,stream = sys.stderr).sort_stats('cumulative').print_stats(30)
+
+### manifests of sharded builds
+def run_record(s, name, quotas):
+	'''
+	returns what the manifest records of the run of slice s of the quotas,
+	written by name
+	'''
+	if DEDUP_SCOPE == 'all':
+		keys = {'all' : sorted(quotas[0].qset)} if quotas else {}
+	else:
+		keys = dict((str(quota.q_type),sorted(quota.qset)) for quota in quotas)
+	return {'slice' : s, 'writer' : name, 'types' : dict((quota.q_type,quota.summary()) for quota in quotas), 'keys' : keys}
+
+def merge_answers(runs):
+	'''adds up the answer counts of run records by q type'''
+	answers = {}
+	for run in runs:
+		for q_type, quota in run['types'].iteritems():
+			counts = answers.setdefault(q_type,defaultdict(int))
+			for a, c in quota['answers'].iteritems():
+				counts[a] += c
+	return answers
+
+def build_options(p):
+	'''
+	returns the options every shard of a build must share, as recorded in
+	its manifest
+	'''
+	options = ['seed','q_type','n_matches','total_count','workers','output_format','image_format','shared_images','features','underfilled','dedup','dedup_scope','min_plies','max_plies','min_elo','max_elo','event','time_control','results']
+	build = dict((option,getattr(p,option)) for option in options)
+	# the nodes of a build may keep the pgn file under other paths and mtimes
+	build.update({'pgn' : [os.path.basename(p.pgn_file),os.path.getsize(p.pgn_file)], 'shards' : p.shard[1]})
+	return build
+
+def load_manifest(name):
+	with open(os.path.join(PATH,name+'.manifest')) as f:
+		return json.load(f)
+
+def extension(previous, s):
+	'''
+	returns what generate needs to extend slice s of the run of the
+	manifest previous, None without one
+	'''
+	if previous is None:
+		return None
+	return {'base' : previous['next'], 'types' : previous['slices'].get(str(s),{}).get('types',{}), 'keys' : previous['keys']}
+
+def write_manifest(p, name, runs, previous = None):
+	'''
+	writes PATH/<name>.manifest: the build options, the shard, the writers
+	whose outputs it made, and for every slice of its quotas by q type the
+	ranges of question numbers used and the answer counts, added to those
+	of the manifest previous the run extends. types adds up the slices,
+	keys holds the dedup keys in use and next the first question number
+	an extension may use.
+	'''
+	if previous is None:
+		manifest = {'extensions' : 0, 'next' : 0, 'writers' : [], 'slices' : {}, 'keys' : {}}
+	else:
+		manifest = dict(previous, extensions = previous['extensions'] + 1)
+	manifest.update({'build' : build_options(p), 'shard' : p.shard[0], 'next' : manifest['next'] + p.total_count})
+	for run in runs:
+		manifest['writers'].append(run['writer'])
+		record = manifest['slices'].setdefault(str(run['slice']),{'writers' : [], 'types' : {}})
+		record['writers'].append(run['writer'])
+		for q_type, quota in run['types'].iteritems():
+			t = record['types'].setdefault(str(q_type),{'ranges' : [], 'total' : 0, 'answers' : {}})
+			t['ranges'].append([quota['offset'],quota['total']])
+			t['total'] += quota['total']
+			for a, c in quota['answers'].iteritems():
+				t['answers'][a] = t['answers'].get(a,0) + c
+		for scope, keys in run['keys'].iteritems():
+			manifest['keys'][scope] = sorted(set(manifest['keys'].get(scope,[])) | set(keys))
+
+	types = {}
+	for record in manifest['slices'].itervalues():
+		for q_type, t in record['types'].iteritems():
+			total = types.setdefault(q_type,{'total' : 0, 'count' : p.total_count / len(ANSWERS[int(q_type)]) + SLACK[int(q_type)], 'ranges' : [], 'answers' : defaultdict(int)})
+			total['total'] += t['total']
+			total['ranges'].extend(t['ranges'])
+			for a, c in t['answers'].iteritems():
+				total['answers'][a] += c
+	for t in types.itervalues():
+		t['ranges'].sort()
+	manifest['types'] = types
+
+	f_name = os.path.join(PATH,name+'.manifest')
+	with open(f_name+'.tmp','w') as f:
+		json.dump(manifest,f,sort_keys = True,indent = 1)
+	os.rename(f_name+'.tmp',f_name)
+
+### replay a game on a single mutable board
+PATH_SEED = 0xcbf29ce484222325
+PATH_PRIME = 0x100000001b3
+MASK64 = (1 << 64) - 1
+
+class Position(object):
+	'''The position after ply moves of a game, given as move codes.
+
+	board holds the position and path a 64 bit FNV-1a hash of the codes of
+	its moves. replay() updates both in place, so a Position stands for
+	one ply at a time and must not be kept across plies. The SAN of the
+	moves is only worked out when a question is written: san() replays the
+	game on a board of its own, no further than it is asked for and
+	never twice.
+	'''
+	__slots__ = ['codes','ply','board','path','moves','line']
+
+	def __init__(self, codes):
+		self.codes = codes
+		self.ply = 0
+		self.board = chess.Board()
+		self.path = PATH_SEED
+		self.moves = []
+		self.line = None
+
+	def san(self):
+		'''returns the SAN of the moves leading to the position'''
+		if self.line is None:
+			self.line = chess.Board()
+		while len(self.moves) < self.ply:
+			move = decode_move(self.codes[len(self.moves)])
+			self.moves.append(self.line.san(move))
+			self.line.push(move)
+		return self.moves[:self.ply]
+
+def replay(position):
+	'''
+	pushes the moves of the game of position onto its board one at a time
+	and yields the board after each push
+	'''
+	board = position.board
+	try:
+		for code in position.codes:
+			board.push(decode_move(code))
+			position.path = ((position.path ^ code) * PATH_PRIME) & MASK64
+			position.ply += 1
+			yield board
+	finally:
+		METRICS.count('positions',position.ply)
+
+def dedup_key(position):
+	'''returns the key telling apart the questions on a position'''
+	return position.board.zobrist_hash() if DEDUP == 'position' else position.path
+
+### write question data
+def write_qa(position,q,a,c, q_text, meta = ''):
+
+	moves = " ".join(position.san())
 	moves = moves[:-1] if moves[-1] == "#" else moves
+	t = time.time()
+	WRITER.write(q,c,[q_text,moves,position.board.fen(),a])
+	METRICS.time('write',time.time() - t)
 
-	print >> open(PREFIX+f_name+'.txt','w'), "\t".join([q_text,moves,fen,a])
-#	print >> open(PREFIX+f_name+'.fen','w'), fen ## if you want to print FEN too, uncomment
-
-CHECK = { 0 : q_checkmate, 1 : q_stalemate, 2 : q_castling_rights, 3 : q_castle, 4 : q_material_adv, 5 : q_material_count, 6 : q_check}
 QTEXT = { 0 : t_checkmate, 1 : t_stalemate, 2 : t_castling_rights, 3 : t_castle, 4 : t_material_adv, 5 : t_material_count, 6: t_check, 7 : t_attack, 8 : t_position, 9 : t_count_all_pieces, 10 : t_count_board , 11 : t_existence_side, 12 : t_existence, 13 : t_legal_move, 14 : t_is_attacked}
 GENERATE = { 0 : g_checkmate, 1: g_stalemate, 2 : g_castling_rights, 3 : g_castle, 4 : g_material_adv, 5 : g_material_count , 6: g_check, 7 : g_attack, 8 : g_position , 9 : g_count_all_pieces, 10 : g_count_board , 11 : g_existence_side, 12 : g_existence, 13 : g_legal_move, 14 : g_is_attacked}
-
-def read_games(pgn_file, n_matches):
-
-	pgn = open(pgn_file)
-	g_count = 0
-	games = []
-	while pgn.tell() != os.fstat(pgn.fileno()).st_size:
-		game = chess.pgn.read_game(pgn)
-		games.append(game)
-		g_count += 1
-		if g_count == n_matches:
-			break
-	print >> sys.stderr, "Total ",g_count,"games has been read"
+ANSWERS = dict((q_type,answer_buckets(q_type)) for q_type in GENERATE)
+# q types whose answer buckets follow from the feature table alone
+INDEXED = [0, 1, 2, 3, 4, 5, 6, 9, 10, 11, 12]
+# q types answered 'yes' by the final position of the games ending in
+TERMINAL = { 0 : 'mate', 1 : 'stalemate'}
+# the count q types, whose buckets can be found for many positions at once
+BATCH = { 4 : b_material_adv, 5 : b_material_count, 9 : b_count_all_pieces, 10 : b_count_board, 11 : b_existence_side, 12 : b_existence}
+SLACK = { 0 : 1, 1 : 1, 2 : 2, 3 : 1, 4 : 1, 5 : FIXED, 6 : 1, 7 : FIXED, 8 : FIXED, 9 : FIXED, 10 : FIXED, 11 : FIXED, 12 : 10, 13 : FIXED, 14 : FIXED}
+# plies each q type looks at: 'walk' every ply after a random start, 'ply' a single random ply, 'last' the final position
+WINDOW = { 0 : [(MIDDLE,END,'ply'),(0,0,'last')], 1 : [(MIDDLE,END,'ply'),(0,0,'last')], 2 : [(START,MIDDLE,'ply')], 3 : [(START,MIDDLE,'ply')], 4 : [(START,MIDDLE,'ply')], 5 : [(START,END,'walk')], 6 : [(MIDDLE,END,'walk')], 7 : [(START,END,'walk')], 8 : [(START,END,'walk')], 9 : [(START,END,'walk')], 10 : [(START,END,'walk')], 11 : [(START,END,'walk')], 12 : [(START,START+5,'walk')], 13 : [(MIDDLE,END,'ply'),(MIDDLE+START,END+MIDDLE,'ply')], 14 : [(START,END,'walk')]}
+
+def game_filter(p):
+	return GameFilter(p.min_plies,p.max_plies,p.min_elo,p.max_elo,p.event,p.time_control,p.results)
+
+def read_games(pgn_file, n_matches, keep = None, shard = (0,1)):
+	'''
+	returns the first n_matches games of pgn_file that keep accepts as
+	arrays of move codes, with shard = (i, N) every N-th of them from the
+	i-th. only those games are ever parsed
+	'''
+	index = PGNIndex(pgn_file)
+	if keep is not None:
+		numbers = keep.select(index.entries)
+		if len(numbers) < len(index):
+			print >> sys.stderr, len(numbers),"of",len(index),"games pass the filters"
+			index = PGNIndex(pgn_file,numbers,index.entries)
+	if n_matches >= 0:
+		index = index[:n_matches]
+	i, n = shard
+	if n > 1:
+		index = index[i::n]
+		print >> sys.stderr, "shard",i,"of",n,":",len(index),"games"
+	games = MoveCache(index)
+	print >> sys.stderr, "Total ",len(games),"games has been read"
 	return games
 
 if __name__ == "__main__":
 	random.seed(0)
 	parser = get_parser()
 	p = parser.parse_args()
-	random.seed(p.seed)
-
-	games = read_games(p.pgn_file, p.n_matches)
+	i, n = p.shard
+	random.seed(p.seed if n == 1 else p.seed * 1000003 + i)
+
+	games = read_games(p.pgn_file, p.n_matches, game_filter(p), p.shard)
+	if p.features:
+		FEATURES = FeatureTable(games)
+	MAX_PASSES = p.max_passes
+	TIME_BUDGET = p.time_budget
+	PATIENCE = p.patience
+	UNDERFILLED = p.underfilled
+	DEDUP = p.dedup
+	DEDUP_SCOPE = p.dedup_scope
+	CHECKPOINT_EVERY = p.checkpoint_every
+	RESUME = p.resume
+	PROFILE = p.profile
 	PATH = p.path
 	if len(p.q_type.split('-')) == 2:
 		st = int(p.q_type.split('-')[0])
@@ -925,11 +1152,46 @@ if __name__ == "__main__":
 		st = int(p.q_type)
 		end = int(p.q_type) +1
 
-	for q_type in xrange(st,end):
-
-		PREFIX = PATH + '/' + str(q_type) + '/'
-
-		os.system('rm -rf '+PREFIX)
-		os.system('mkdir -p '+PREFIX)
-		GENERATE[q_type](q_type,games, p.total_count)
-		print >> sys.stderr, "DONE!",q_type
+	if p.shared_images and p.image_format != 'png':
+		parser.error('--shared-images only applies to --image-format png')
+	if p.resume and p.output_format != 'files' and p.image_archive == 'zip' and p.image_format == 'png':
+		parser.error('--resume cannot continue zip archives, use --image-archive tar')
+	if p.resume and not p.checkpoint_every:
+		parser.error('--resume needs checkpoints')
+
+	q_types = range(st,end)
+	name = 'qa' if n == 1 else 'qa-s'+str(i)
+	previous = None
+	if p.extend:
+		if not os.path.exists(os.path.join(PATH,name+'.manifest')):
+			parser.error('--extend needs the {}.manifest of a finished run in {}'.format(name,PATH))
+		previous = load_manifest(name)
+		changed = [option for option, value in sorted(build_options(p).iteritems()) if option != 'total_count' and previous['build'].get(option) != value]
+		if changed:
+			parser.error('--extend needs the options of the run it extends, except --total-count, but {} changed'.format(', '.join(changed)))
+	if not p.resume and not p.extend:
+		writer_class(p.output_format).prepare(PATH,q_types)
+
+	# every extension writes its own shards, from another RNG stream
+	seed = p.seed
+	if previous is not None:
+		seed = p.seed + 1000033 * (previous['extensions'] + 1)
+		random.seed(seed if n == 1 else seed * 1000003 + i)
+		run_name = name+'-x'+str(previous['extensions'] + 1)
+	else:
+		run_name = name
+	if p.resume:
+		names = [run_name] if p.workers == 1 else [run_name+'-w'+str(w) for w in xrange(p.workers)]
+		missing = [checkpoint_file(run) for run in names if not os.path.exists(checkpoint_file(run))]
+		if missing:
+			parser.error('--resume found no checkpoint {}'.format(', '.join(missing)))
+	METRICS.setup(p.progress_every,metrics_file(p.metrics_file,run_name))
+	if p.workers > 1:
+		runs = generate_parallel(q_types,games,p.total_count,p.workers,seed,p,p.shard,run_name,previous)
+	else:
+		state = load_checkpoint(run_name) if p.resume else None
+		WRITER = make_writer(p,run_name,state['writer'] if state else None)
+		quotas = profiled(run_name,generate,q_types,games,p.total_count,p.shard,run_name,state,extension(previous,i))
+		WRITER.close()
+		runs = [run_record(i,run_name,quotas)]
+	write_manifest(p,name,runs,previous)
@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+'''
+merges the shards of a dataset built on several nodes
+
+Every node runs generate_qa.py with the same options and its own
+--shard i/N, into a PATH of its own. Each shard takes every N-th game and
+1/N of every answer bucket, numbers its questions apart from the other
+shards and leaves a qa-s<i>.manifest next to its output.
+
+	python merge.py --out dataset node0/output node1/output node2/output
+
+copies the questions of all shards into one folder, joins their shard
+indices into qa.index and writes a qa.manifest for the whole dataset. It
+then checks that
+
+ - the shards come from the same build and none is missing,
+ - no question id occurs in more than one shard, and with --strict no
+   dedup key either,
+ - every answer bucket holds at most as many questions as a single node
+   run would allow, and with --reference, that every q type has as many
+   questions as that single node run,
+
+and exits with status 1 if any check fails.
+'''
+
+import argparse, glob, json, os, shutil, sys
+from collections import defaultdict
+
+SKIP = ('.manifest','.index','.checkpoint','.tmp')
+
+def load_manifests(paths):
+	'''returns (path, manifest) for the manifest of every shard in paths'''
+	shards = []
+	for path in paths:
+		for f_name in sorted(glob.glob(os.path.join(path,'*.manifest'))):
+			with open(f_name) as f:
+				shards.append((path,json.load(f)))
+	return shards
+
+def check_build(shards):
+	'''returns the problems keeping the shards from forming one build'''
+	problems = []
+	build = shards[0][1]['build']
+	for path, manifest in shards[1:]:
+		for option in sorted(set(build) | set(manifest['build'])):
+			if build.get(option) != manifest['build'].get(option):
+				problems.append("{} : {} is {}, not {}".format(path,option,manifest['build'].get(option),build.get(option)))
+	found = defaultdict(list)
+	for path, manifest in shards:
+		found[manifest['shard']].append(path)
+	for i in xrange(build['shards']):
+		if len(found[i]) != 1:
+			problems.append("shard {}/{} found {} times {}".format(i,build['shards'],len(found[i]),found[i]))
+	return problems
+
+def copy_outputs(path, out):
+	'''
+	copies the questions, images and arrays of a shard into out. returns the
+	files that are in out already; only shared images may be
+	'''
+	clashes = []
+	for root, dirs, files in os.walk(path):
+		for f_name in files:
+			if f_name.endswith(SKIP):
+				continue
+			source = os.path.join(root,f_name)
+			relative = os.path.relpath(source,path)
+			target = os.path.join(out,relative)
+			if os.path.exists(target):
+				# images are named by the placement they show
+				if relative.split(os.sep)[0] != 'images':
+					clashes.append(relative)
+				continue
+			if not os.path.isdir(os.path.dirname(target)):
+				os.makedirs(os.path.dirname(target))
+			shutil.copyfile(source,target)
+	return clashes
+
+def read_records(path, manifest):
+	'''
+	yields (q_type, q_id, moves, fen) for every question written by the
+	writers of a shard
+	'''
+	build = manifest['build']
+	if build['output_format'] == 'files':
+		for q_type in sorted(manifest['types'],key = int):
+			for f_name in glob.glob(os.path.join(path,q_type,'q*.txt')):
+				with open(f_name) as f:
+					fields = f.readline().rstrip('\n').split('\t')
+				yield int(q_type), os.path.basename(f_name)[:-4], fields[1], fields[2]
+		return
+	for writer in manifest['writers']:
+		with open(os.path.join(path,writer+'.index')) as index:
+			for line in index:
+				text_name = line.split('\t')[1]
+				for record in open(os.path.join(path,text_name)):
+					if build['output_format'] == 'jsonl':
+						record = json.loads(record)
+						yield record['q_type'], record['id'], record['moves'], record['fen']
+					else:
+						fields = record.rstrip('\n').split('\t')
+						yield int(fields[1]), fields[0], fields[3], fields[4]
+
+def dedup_key(build, q_type, moves, fen):
+	'''returns the key generate_qa.py keeps questions unique by'''
+	# the placement, turn, castling and en passant fields of the fen
+	key = moves if build['dedup'] == 'path' else " ".join(fen.split()[:4])
+	return key if build['dedup_scope'] == 'all' else (q_type,key)
+
+def check_dedup(shards):
+	'''
+	returns the number of question ids and of dedup keys found in more than
+	one shard, by q type
+	'''
+	ids = {}
+	keys = {}
+	id_clashes = defaultdict(int)
+	key_clashes = defaultdict(int)
+	for path, manifest in shards:
+		i = manifest['shard']
+		for q_type, q_id, moves, fen in read_records(path,manifest):
+			if ids.setdefault(q_id,i) != i:
+				id_clashes[q_type] += 1
+			if keys.setdefault(dedup_key(manifest['build'],q_type,moves,fen),i) != i:
+				key_clashes[q_type] += 1
+	return id_clashes, key_clashes
+
+def merge_types(shards):
+	'''adds up the totals, ranges and answer counts of the shards'''
+	types = {}
+	for path, manifest in shards:
+		for q_type, t in manifest['types'].iteritems():
+			merged = types.setdefault(q_type,{'total' : 0, 'count' : t['count'], 'ranges' : [], 'answers' : defaultdict(int)})
+			merged['total'] += t['total']
+			merged['ranges'].extend(t['ranges'])
+			for a, c in t.get('answers',{}).iteritems():
+				merged['answers'][a] += c
+	for t in types.itervalues():
+		t['ranges'].sort()
+	return types
+
+def check_balance(build, types, reference = None):
+	'''
+	returns the problems with the answer balance of the merged types,
+	against the limits of a single node run and its question counts
+	'''
+	problems = []
+	for q_type in sorted(types,key = int):
+		t = types[q_type]
+		print >> sys.stderr, "type {} : {}/{} questions, largest answer bucket {} (single node limit {})".format(q_type,t['total'],build['total_count'],max(t['answers'].values() or [0]),t['count'])
+		# redistribute raises the limits of the buckets that can take more
+		if build['underfilled'] == 'drop':
+			over = [a for a, c in t['answers'].iteritems() if c > t['count']]
+			if over:
+				problems.append("type {} : {} answer buckets over the limit".format(q_type,len(over)))
+		if reference is not None:
+			single = reference['types'].get(q_type,{'total' : 0, 'answers' : {}})
+			answers = single.get('answers',{})
+			# which buckets fill first follows the order the games are played in
+			diff = max([abs(answers.get(a,0) - t['answers'].get(a,0)) for a in set(answers) | set(t['answers'])] or [0])
+			print >> sys.stderr, "type {} : single node run {} questions, answer buckets differ by up to {}".format(q_type,single['total'],diff)
+			if single['total'] != t['total']:
+				problems.append("type {} : {} questions, the single node run {}".format(q_type,t['total'],single['total']))
+	return problems
+
+def merge(paths, out, reference = None, strict = False):
+	'''merges the shards in paths into out, returns the problems found'''
+	shards = load_manifests(paths)
+	if not shards:
+		return ["no manifest in " + " ".join(paths)]
+	shards.sort(key = lambda shard: shard[1]['shard'])
+	problems = check_build(shards)
+	if problems:
+		return problems
+	build = shards[0][1]['build']
+
+	if not os.path.isdir(out):
+		os.makedirs(out)
+	for path, manifest in shards:
+		problems.extend("{} : {} is in another shard".format(path,clash) for clash in copy_outputs(path,out))
+	writers = []
+	if build['output_format'] != 'files':
+		with open(os.path.join(out,'qa.index'),'w') as index:
+			for path, manifest in shards:
+				for writer in manifest['writers']:
+					with open(os.path.join(path,writer+'.index')) as f:
+						index.write(f.read())
+		writers = ['qa']
+
+	id_clashes, key_clashes = check_dedup(shards)
+	for q_type in sorted(set(id_clashes) | set(key_clashes)):
+		print >> sys.stderr, "type {} : {} question ids and {} dedup keys in more than one shard".format(q_type,id_clashes.get(q_type,0),key_clashes.get(q_type,0))
+	if id_clashes:
+		problems.append("{} question ids in more than one shard".format(sum(id_clashes.values())))
+	if key_clashes and strict:
+		problems.append("{} dedup keys in more than one shard".format(sum(key_clashes.values())))
+
+	types = merge_types(shards)
+	problems.extend(check_balance(build,types,reference))
+
+	build = dict(build, shards = 1)
+	manifest = {'build' : build, 'shard' : 0, 'writers' : writers, 'types' : types, 'merged' : [path for path, manifest in shards]}
+	with open(os.path.join(out,'qa.manifest'),'w') as f:
+		json.dump(manifest,f,sort_keys = True,indent = 1)
+	return problems
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument('paths', nargs = '+', help = 'output folders of the shards')
+	parser.add_argument('--out', action='store', dest='out',help='folder to merge the shards into',required = True)
+	parser.add_argument('--reference', action='store', dest='reference',help='qa.manifest of a single node run of the same build to compare the answer counts with',default = None)
+	parser.add_argument('--strict', action='store_true', dest='strict',help='fail on dedup keys in more than one shard too. shards share no games, but games of different shards may share their opening moves')
+	p = parser.parse_args()
+
+	reference = None
+	if p.reference:
+		with open(p.reference) as f:
+			reference = json.load(f)
+	problems = merge(p.paths,p.out,reference,p.strict)
+	for problem in problems:
+		print >> sys.stderr, problem
+	if problems:
+		sys.exit(1)
+	print >> sys.stderr, "merged",len(load_manifests(p.paths)),"shards into",p.out
@@ -0,0 +1,87 @@
+#! /usr/bin/env python
+'''
+counters and timers of a generation run
+
+METRICS holds the figures of the process it lives in: the positions
+replayed, the predicate evaluations and their time by q type, the
+questions each answer bucket turned away, the images rendered and the
+bytes written. generate_qa.py prints a progress line from them at most
+every few seconds and saves them as json with --metrics-file. Worker
+processes each keep and save their own.
+'''
+
+import json, os, sys, threading, time
+from collections import defaultdict
+
+class Metrics(object):
+	'''Named counters and timers, with rate limited progress.
+
+	count() and time() are for the search thread alone. add() takes a lock
+	and is for the render and writer threads of a Pipeline. rejected counts
+	the questions of every (q type, answer bucket) dropped because the
+	bucket was full. Names are strings, or (name, q type) for the figures
+	kept by q type.
+	'''
+	def __init__(self, every = 10.0, f_name = None, name = None):
+		self.setup(every,f_name,name)
+
+	def setup(self, every, f_name, name = None):
+		'''
+		starts over, with progress due every `every` seconds, 0 for never.
+		progress lines start with name, if given
+		'''
+		self.every = every
+		self.f_name = f_name
+		self.name = name
+		self.counters = defaultdict(int)
+		self.timers = defaultdict(float)
+		self.rejected = defaultdict(int)
+		self.lock = threading.Lock()
+		self.start = time.time()
+		self.next = self.start + every if every else float('inf')
+
+	def count(self, name, n = 1):
+		self.counters[name] += n
+
+	def time(self, name, seconds):
+		self.timers[name] += seconds
+
+	def add(self, name, n = 1, seconds = None):
+		with self.lock:
+			self.counters[name] += n
+			if seconds is not None:
+				self.timers[name] += seconds
+
+	def reject(self, q_type, a):
+		self.rejected[q_type,a] += 1
+
+	def due(self):
+		'''True once every `every` seconds'''
+		return time.time() >= self.next
+
+	def progress(self, line):
+		'''prints a progress line and saves the metrics file'''
+		now = time.time()
+		self.next = now + self.every if self.every else float('inf')
+		print >> sys.stderr, "[{}{:8.1f}s] {}".format(self.name + ' ' if self.name else '',now - self.start,line)
+		self.save()
+
+	def snapshot(self):
+		'''returns the metrics as json, with (name, q_type) keys as name:q_type'''
+		def named(d):
+			return dict((":".join(str(part) for part in name) if isinstance(name,tuple) else name,value) for name, value in d.items())
+		with self.lock:
+			rejected = defaultdict(dict)
+			for (q_type, a), n in self.rejected.items():
+				rejected[str(q_type)][str(a)] = n
+			return {'elapsed' : time.time() - self.start, 'counters' : named(self.counters), 'timers' : named(self.timers), 'rejected' : rejected}
+
+	def save(self):
+		'''writes the metrics to f_name, if there is one'''
+		if self.f_name is None:
+			return
+		with open(self.f_name+'.tmp','w') as f:
+			json.dump(self.snapshot(),f,sort_keys = True,indent = 1)
+		os.rename(self.f_name+'.tmp',self.f_name)
+
+METRICS = Metrics()
@@ -0,0 +1,506 @@
+#! /usr/bin/env python
+'''
+output backends for generated questions
+
+FileWriter writes a .txt and a .png file per question into a folder per
+question type. ShardWriter appends the questions to rolling shards: the
+text records to .jsonl or .tsv files and the images to .tar or .zip
+archives, with an index of the shards. Instead of png images both can
+store boards as arrays in .npy shards. Pipeline moves the rendering and
+writing of either one to background threads.
+
+Every writer can checkpoint(): flush what it has written and return a
+small state, from which a writer created with resume = state continues
+after a crash, dropping anything written after the checkpoint.
+'''
+
+import glob, hashlib, json, os, re, shutil, struct, sys, tarfile, threading, time, zipfile
+import Queue
+from collections import defaultdict
+from cStringIO import StringIO
+from visualizer import renderer, array_renderer, fen_planes, PLANES
+from metrics import METRICS
+
+FORMATS = ['files','jsonl','tsv']
+ARCHIVES = ['tar','zip']
+IMAGE_FORMATS = ['png','npy','planes']
+FIELDS = ['q_text','moves','fen','answer']
+BUFFER = 1 << 20
+
+def image_name(fen):
+	'''Return the content address of the image of a position.'''
+	digest = hashlib.sha1(fen.split()[0]).hexdigest()
+	return os.path.join('images',digest[:2],digest+'.png')
+
+def encode_png(fen):
+	'''Return the image of a position as png data.'''
+	t = time.time()
+	data = StringIO()
+	renderer().draw(fen).save(data,'PNG')
+	METRICS.add('renders',1,time.time() - t)
+	return data.getvalue()
+
+def encode_image(fen, image_format = 'png'):
+	'''Return the image of a position as png data or raw array bytes.'''
+	if image_format == 'png':
+		return encode_png(fen)
+	t = time.time()
+	if image_format == 'npy':
+		data = array_renderer().draw(fen).tobytes()
+	else:
+		data = fen_planes(fen).tobytes()
+	METRICS.add('renders',1,time.time() - t)
+	return data
+
+def image_shape(image_format):
+	if image_format == 'npy':
+		return array_renderer().shape
+	return (8,8,len(PLANES))
+
+def remove_shards(path):
+	'''Remove the shards, indices and manifests of earlier runs from path.'''
+	shard = re.compile(r'.*-\d{5}\.(' + '|'.join(FORMATS[1:] + ARCHIVES + IMAGE_FORMATS[1:2]) + r')$')
+	for f_name in glob.glob(os.path.join(path,'*')):
+		if shard.match(f_name) or f_name.endswith('.index') or f_name.endswith('.manifest'):
+			os.remove(f_name)
+
+class ArrayStore(object):
+	'''Appends uint8 arrays of one shape to rolling .npy shards.
+
+	Shard k is <path>/<name>-<k>.npy and holds up to shard_size arrays.
+	Rows are appended as they come and the header is rewritten with the
+	row count when the shard is closed, so the shards can be opened with
+	numpy.load(f_name, mmap_mode='r').
+	'''
+	HEADER = 128
+
+	def __init__(self, path, name, shape, shard_size, resume = None):
+		self.path = path
+		self.name = name
+		self.shape = tuple(shape)
+		self.shard_size = shard_size
+		self.shard = -1
+		self.f = None
+		if resume is None:
+			self.open_shard()
+		else:
+			self.shard, self.rows = resume
+			self.f_name = "{}-{:05d}.npy".format(self.name,self.shard)
+			self.f = open(os.path.join(self.path,self.f_name),'r+b',BUFFER)
+			self.f.truncate(self.HEADER + self.rows * reduce(lambda a, b : a * b,self.shape,1))
+			self.f.seek(0,os.SEEK_END)
+
+	def header(self, rows):
+		header = "{'descr': '|u1', 'fortran_order': False, 'shape': %r, }" % ((rows,) + self.shape,)
+		header = header.ljust(self.HEADER - 11) + '\n'
+		return '\x93NUMPY\x01\x00' + struct.pack('<H',len(header)) + header
+
+	def open_shard(self):
+		self.shard += 1
+		self.rows = 0
+		self.f_name = "{}-{:05d}.npy".format(self.name,self.shard)
+		self.f = open(os.path.join(self.path,self.f_name),'wb',BUFFER)
+		self.f.write(self.header(0))
+
+	def close_shard(self):
+		self.f.seek(0)
+		self.f.write(self.header(self.rows))
+		self.f.close()
+
+	def add(self, data):
+		'''Append the raw bytes of an array, return it as <file>:<row>.'''
+		if self.rows == self.shard_size:
+			self.close_shard()
+			self.open_shard()
+		self.f.write(data)
+		METRICS.add('bytes',len(data))
+		self.rows += 1
+		return "{}:{}".format(self.f_name,self.rows - 1)
+
+	def checkpoint(self):
+		self.f.flush()
+		return self.shard, self.rows
+
+	def close(self):
+		self.close_shard()
+
+class ImageStore(object):
+	'''Board images shared by every question showing the same placement.
+
+	Images are named by the SHA-1 of the piece placement field of the FEN
+	and kept under <path>/images/. A placement is rendered only the first
+	time it is seen, by this or any earlier run writing into path.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.known = set()
+
+	def name(self, fen):
+		'''Return the image path of a position, relative to the output path.'''
+		return image_name(fen)
+
+	def has(self, fen):
+		name = self.name(fen)
+		return name in self.known or os.path.exists(os.path.join(self.path,name))
+
+	def put(self, fen, png = None):
+		'''Store the image of a position if needed and return its name.'''
+		name = self.name(fen)
+		if name in self.known:
+			return name
+		f_name = os.path.join(self.path,name)
+		if not os.path.exists(f_name):
+			folder = os.path.dirname(f_name)
+			if not os.path.isdir(folder):
+				try:
+					os.makedirs(folder)
+				except OSError:
+					pass
+			# write then rename, other workers may store the same image
+			tmp_name = "{}.{}.tmp".format(f_name,os.getpid())
+			png = png or encode_png(fen)
+			with open(tmp_name,'wb') as f:
+				f.write(png)
+			os.rename(tmp_name,f_name)
+			METRICS.add('bytes',len(png))
+		self.known.add(name)
+		return name
+
+class FileWriter(object):
+	'''Writes q<type>_<n>.txt and q<type>_<n>.png into <path>/<type>/.
+
+	With shared_images, or with an image_format other than png, the image
+	is stored elsewhere and named in a fifth field of the .txt file: as an
+	ImageStore image or as <name>-<k>.npy:<row> of an ArrayStore.
+	'''
+	def __init__(self, path, shared_images = False, image_format = 'png', name = 'qa', shard_size = 10000, resume = None):
+		self.path = path
+		self.image_format = image_format
+		self.images = ImageStore(path) if shared_images else None
+		self.arrays = None
+		if image_format != 'png':
+			self.arrays = ArrayStore(path,name,image_shape(image_format),shard_size,resume)
+
+	@staticmethod
+	def prepare(path, q_types):
+		'''Empty the folders of q_types.'''
+		for q_type in q_types:
+			folder = os.path.join(path,str(q_type))
+			shutil.rmtree(folder,ignore_errors = True)
+			os.makedirs(folder)
+		remove_shards(path)
+
+	def render(self, q_type, c, fen):
+		'''Return the image data a question needs, None if it is stored.'''
+		if self.images is not None and self.images.has(fen):
+			return None
+		return encode_image(fen,self.image_format)
+
+	def write(self, q_type, c, fields, data = None):
+		f_name = os.path.join(self.path,str(q_type),"q"+str(q_type)+"_"+str(c))
+		fen = fields[2]
+		if self.arrays is not None:
+			fields = fields + [self.arrays.add(data or encode_image(fen,self.image_format))]
+		elif self.images is not None:
+			fields = fields + [self.images.put(fen,data)]
+		else:
+			data = data or encode_png(fen)
+			with open(f_name+'.png','wb') as f:
+				f.write(data)
+			METRICS.add('bytes',len(data))
+		text = "\t".join(fields)
+		with open(f_name+'.txt','w') as f:
+			print >> f, text
+		METRICS.add('bytes',len(text) + 1)
+
+	def checkpoint(self):
+		# every question has its own files, only arrays need to be tracked
+		return self.arrays.checkpoint() if self.arrays is not None else None
+
+	def close(self):
+		if self.arrays is not None:
+			self.arrays.close()
+
+class ShardWriter(object):
+	'''Appends questions to rolling shards.
+
+	Shard k of a writer called name is <name>-<k>.<format> for the text
+	records and <name>-<k>.<archive> for the images. A new shard is started
+	every shard_size questions, and <name>.index gets a line per finished
+	shard: shard, text file, archive, first and last record id and number
+	of records. A record names its image as <archive>:<member>; with
+	shared_images the member is the content address of the placement and
+	is stored only in the first shard that needs it. With an image_format
+	other than png the archives are replaced by <name>-<k>.npy, whose row
+	r is the image of the r-th record of text shard k. Zip archives cannot
+	be resumed, as their directory is only written when they are closed.
+	'''
+	def __init__(self, path, name = 'qa', text_format = 'jsonl', archive = 'tar', shard_size = 10000, shared_images = False, image_format = 'png', resume = None):
+		self.path = path
+		self.name = name
+		self.text_format = text_format
+		self.archive_format = archive
+		self.shard_size = shard_size
+		self.shared_images = shared_images
+		self.image_format = image_format
+		self.images = {}
+		self.shard = -1
+		self.text = None
+		self.archive = None
+		self.arrays = None
+		if resume is not None:
+			self.resume(resume)
+			return
+		if image_format != 'png':
+			self.arrays = ArrayStore(path,name,image_shape(image_format),shard_size)
+		self.index = open(os.path.join(path,name+'.index'),'w')
+		self.open_shard()
+
+	@staticmethod
+	def prepare(path, q_types):
+		'''Remove the shards and indices of earlier runs.'''
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		remove_shards(path)
+
+	def shard_name(self, ext):
+		return "{}-{:05d}.{}".format(self.name,self.shard,ext)
+
+	def open_shard(self):
+		self.shard += 1
+		self.count = 0
+		self.first = None
+		self.last = None
+		self.text_name = self.shard_name(self.text_format)
+		self.archive_name = self.shard_name(self.archive_format)
+		self.text = open(os.path.join(self.path,self.text_name),'w',BUFFER)
+		archive = os.path.join(self.path,self.archive_name)
+		if self.arrays is not None:
+			self.archive_name = self.shard_name('npy')
+		elif self.archive_format == 'tar':
+			self.archive = tarfile.open(archive,'w',fileobj = open(archive,'wb',BUFFER))
+		else:
+			self.archive = zipfile.ZipFile(archive,'w',zipfile.ZIP_STORED,True)
+
+	def checkpoint(self):
+		self.text.flush()
+		archive = None
+		if self.archive is not None and self.archive_format == 'tar':
+			self.archive.fileobj.flush()
+			archive = self.archive.offset
+		elif self.archive is not None:
+			# a zip archive cannot be resumed, see the class docstring
+			self.archive.fp.flush()
+		self.index.flush()
+		return {'shard' : self.shard, 'count' : self.count, 'first' : self.first, 'last' : self.last, 'text' : self.text.tell(), 'archive' : archive, 'index' : self.index.tell(), 'images' : dict(self.images), 'arrays' : self.arrays.checkpoint() if self.arrays is not None else None}
+
+	def resume(self, state):
+		'''reopens the shards of a checkpoint and drops what follows it'''
+		def reopen(f_name, size):
+			f = open(os.path.join(self.path,f_name),'r+b',BUFFER)
+			f.truncate(size)
+			f.seek(size)
+			return f
+		self.shard = state['shard']
+		self.count = state['count']
+		self.first = state['first']
+		self.last = state['last']
+		self.images = dict(state['images'])
+		self.index = reopen(self.name+'.index',state['index'])
+		self.text_name = self.shard_name(self.text_format)
+		self.archive_name = self.shard_name(self.archive_format)
+		self.text = reopen(self.text_name,state['text'])
+		if state['arrays'] is not None:
+			self.arrays = ArrayStore(self.path,self.name,image_shape(self.image_format),self.shard_size,state['arrays'])
+			self.archive_name = self.shard_name('npy')
+		else:
+			# a tar archive in 'w' mode carries on from the file position
+			self.archive = tarfile.open(self.archive_name,'w',fileobj = reopen(self.archive_name,state['archive']))
+
+	def close_shard(self):
+		self.text.close()
+		if self.archive is not None:
+			self.archive.close()
+			if self.archive_format == 'tar':
+				self.archive.fileobj.close()
+		if self.count > 0:
+			print >> self.index, "\t".join([str(self.shard),self.text_name,self.archive_name,self.first,self.last,str(self.count)])
+			self.index.flush()
+
+	def add_image(self, member, data):
+		METRICS.add('bytes',len(data))
+		# members carry a fixed date, so that a run with the same seed
+		# writes the same archives
+		if self.archive_format == 'tar':
+			info = tarfile.TarInfo(member)
+			info.size = len(data)
+			self.archive.addfile(info,StringIO(data))
+		else:
+			self.archive.writestr(zipfile.ZipInfo(member),data)
+
+	def render(self, q_type, c, fen):
+		'''Return the image data a question needs, None if it is stored.'''
+		if self.shared_images and image_name(fen) in self.images:
+			return None
+		return encode_image(fen,self.image_format)
+
+	def write(self, q_type, c, fields, data = None):
+		if self.count == self.shard_size:
+			self.close_shard()
+			self.open_shard()
+
+		q_id = "q"+str(q_type)+"_"+str(c)
+		fen = fields[2]
+		if self.arrays is not None:
+			image = self.arrays.add(data or encode_image(fen,self.image_format))
+		elif not self.shared_images:
+			member = q_id + '.png'
+			self.add_image(member,data or encode_png(fen))
+			image = self.archive_name + ':' + member
+		else:
+			member = image_name(fen)
+			if member not in self.images:
+				self.add_image(member,data or encode_png(fen))
+				self.images[member] = self.archive_name + ':' + member
+			image = self.images[member]
+
+		if self.text_format == 'jsonl':
+			record = dict(zip(FIELDS,fields))
+			record.update({'id' : q_id, 'q_type' : q_type, 'image' : image})
+			text = json.dumps(record,sort_keys = True)
+		else:
+			text = "\t".join([q_id,str(q_type)] + fields + [image])
+		print >> self.text, text
+		METRICS.add('bytes',len(text) + 1)
+
+		self.count += 1
+		if self.first is None:
+			self.first = q_id
+		self.last = q_id
+
+	def close(self):
+		self.close_shard()
+		if self.arrays is not None:
+			self.arrays.close()
+		self.index.close()
+
+class Pipeline(object):
+	'''Renders and writes questions in background threads.
+
+	write() only queues a question, blocking while queue_size questions
+	are waiting, so the search never waits on PIL or the disk. A pool of
+	render threads encodes the images and a single writer thread hands
+	them to the wrapped writer in the order they were queued. close()
+	drains the queue and reports the time spent in every stage.
+	'''
+	def __init__(self, writer, render_workers, queue_size = 256):
+		self.writer = writer
+		self.todo = Queue.Queue(queue_size)
+		self.done = Queue.Queue()
+		self.seq = 0
+		self.error = None
+		self.written = 0
+		self.flushed = threading.Condition()
+		self.lock = threading.Lock()
+		self.times = defaultdict(float)
+		self.start = time.time()
+		self.renderers = [threading.Thread(target = self.render_loop) for i in xrange(render_workers)]
+		self.writer_thread = threading.Thread(target = self.write_loop)
+		for thread in self.renderers + [self.writer_thread]:
+			thread.daemon = True
+			thread.start()
+
+	def write(self, q_type, c, fields):
+		if self.error is not None:
+			raise self.error
+		t = time.time()
+		self.todo.put((self.seq,q_type,c,fields))
+		self.times['blocked'] += time.time() - t
+		self.seq += 1
+
+	def render_loop(self):
+		spent = 0.0
+		while True:
+			job = self.todo.get()
+			if job is None:
+				break
+			seq, q_type, c, fields = job
+			t = time.time()
+			try:
+				data = self.writer.render(q_type,c,fields[2])
+			except Exception, e:
+				self.error = e
+				data = None
+			spent += time.time() - t
+			self.done.put((seq,q_type,c,fields,data))
+		with self.lock:
+			self.times['render'] += spent
+		self.done.put(None)
+
+	def write_loop(self):
+		pending = {}
+		seq = 0
+		running = len(self.renderers)
+		while running:
+			item = self.done.get()
+			if item is None:
+				running -= 1
+				continue
+			pending[item[0]] = item
+			while seq in pending:
+				_, q_type, c, fields, data = pending.pop(seq)
+				t = time.time()
+				try:
+					self.writer.write(q_type,c,fields,data)
+				except Exception, e:
+					self.error = e
+				self.times['write'] += time.time() - t
+				seq += 1
+				with self.flushed:
+					self.written = seq
+					self.flushed.notify()
+
+	def checkpoint(self):
+		'''waits until every queued question is written'''
+		with self.flushed:
+			while self.written < self.seq and self.error is None:
+				self.flushed.wait()
+		if self.error is not None:
+			raise self.error
+		return self.writer.checkpoint()
+
+	def close(self):
+		search = time.time() - self.start - self.times['blocked']
+		for thread in self.renderers:
+			self.todo.put(None)
+		for thread in self.renderers + [self.writer_thread]:
+			thread.join()
+		t = time.time()
+		self.writer.close()
+		self.times['write'] += time.time() - t
+		total = time.time() - self.start
+		if self.error is not None:
+			raise self.error
+
+		def rate(seconds):
+			return self.seq / seconds if seconds > 0 else float('inf')
+		print >> sys.stderr, "pipeline : {} questions in {:.2f}s, {:.1f} questions/s".format(self.seq,total,rate(total))
+		print >> sys.stderr, "  search : {:.2f}s, {:.1f} questions/s, blocked on a full queue {:.2f}s".format(search,rate(search),self.times['blocked'])
+		print >> sys.stderr, "  render : {:.2f}s in {} threads, {:.1f} questions/s per thread".format(self.times['render'],len(self.renderers),rate(self.times['render']))
+		print >> sys.stderr, "  write  : {:.2f}s, {:.1f} questions/s".format(self.times['write'],rate(self.times['write']))
+
+def writer_class(output_format):
+	return FileWriter if output_format == 'files' else ShardWriter
+
+def make_writer(p, name = 'qa', resume = None):
+	'''
+	Return the writer selected by the command line options p, continuing
+	from the checkpoint state resume if given.
+	'''
+	if p.output_format == 'files':
+		writer = FileWriter(p.path,p.shared_images,p.image_format,name,p.shard_size,resume)
+	else:
+		writer = ShardWriter(p.path,name,p.output_format,p.image_archive,p.shard_size,p.shared_images,p.image_format,resume)
+	if p.render_workers > 0:
+		writer = Pipeline(writer,p.render_workers)
+	return writer
@@ -0,0 +1,342 @@
+#! /usr/bin/env python
+'''
+byte offset index of the games in a pgn file
+
+The index is built once with a plain scan of the headers and movetext,
+without parsing any moves, and is saved next to the pgn file as
+<pgn file>.idx. Games are parsed only when MoveCache first encodes them
+into compact move arrays, which runs replay them from.
+
+The index keeps the headers GameFilter selects games by, so that games a
+run does not want are never parsed. MoveCache classifies the final
+position of the games it encodes as 'mate', 'stalemate' or '-'.
+'''
+
+import chess, chess.pgn, mmap, os, re
+from array import array
+from collections import namedtuple
+
+INDEX_VERSION = 5
+CACHE_VERSION = 3
+TERMINALS = ['-','mate','stalemate']
+
+Entry = namedtuple('Entry',['offset','plies','result','white_elo','black_elo','event','time_control'])
+
+HEADER = re.compile(r'\[(\w+)\s+"(.*)"\]')
+COMMENT = re.compile(r'\{[^}]*\}|;.*$',re.M)
+MOVE_NUMBER = re.compile(r'^\d+\.+')
+RESULTS = set(['1-0','0-1','1/2-1/2','*'])
+
+def main_line(movetext):
+	'''
+	returns the main line moves of a game's movetext
+
+	>>> main_line('1. e4 ; a comment with words\\n e5 2. Nf3 {a {b} (2. f4 exf4 (2... d5)) Nc6 $1 3. Bb5!? 1-0\\n')
+	['e4', 'e5', 'Nf3', 'Nc6', 'Bb5!?']
+	'''
+	moves = []
+	depth = 0
+	for token in COMMENT.sub(' ',movetext).replace('(',' ( ').replace(')',' ) ').split():
+		if token == '(':
+			depth += 1
+		elif token == ')':
+			depth -= 1
+		elif depth == 0:
+			token = MOVE_NUMBER.sub('',token)
+			if token and token not in RESULTS and token[0] != '$':
+				moves.append(token)
+	return moves
+
+def count_plies(movetext):
+	'''
+	counts the main line moves of a game's movetext
+	'''
+	return len(main_line(movetext))
+
+def header(headers, name):
+	return headers.get(name,'').replace('\t',' ')
+
+def scan(pgn_file):
+	'''
+	returns an Entry for every game in pgn_file
+	'''
+	entries = []
+	def close(offset, headers, movetext):
+		plies = int(headers['PlyCount']) if 'PlyCount' in headers else count_plies(" ".join(movetext))
+		entries.append(Entry(offset,plies,headers.get('Result','*'),header(headers,'WhiteElo'),header(headers,'BlackElo'),header(headers,'Event'),header(headers,'TimeControl')))
+
+	start = None
+	offset = 0
+	in_header = False
+	headers = {}
+	movetext = []
+	for line in open(pgn_file,'rb'):
+		if line.startswith('['):
+			if not in_header:
+				if start is not None:
+					close(start,headers,movetext)
+				start = offset
+				in_header = True
+				headers = {}
+				movetext = []
+			m = HEADER.match(line)
+			if m:
+				headers[m.group(1)] = m.group(2)
+		elif line.strip():
+			in_header = False
+			if start is None:
+				start = offset
+			movetext.append(line)
+		offset += len(line)
+	if start is not None:
+		close(start,headers,movetext)
+	return entries
+
+def file_key(pgn_file):
+	st = os.stat(pgn_file)
+	return "{}\t{}\t{}".format(INDEX_VERSION,st.st_size,int(st.st_mtime))
+
+def load_index(pgn_file):
+	'''
+	returns the index of pgn_file, scanning the file only if there is no
+	up to date saved index
+	'''
+	idx_file = pgn_file + '.idx'
+	key = file_key(pgn_file)
+	if os.path.exists(idx_file):
+		with open(idx_file) as f:
+			if f.readline().rstrip('\n') == key:
+				entries = []
+				for line in f:
+					entry = Entry(*line.rstrip('\n').split('\t'))
+					entries.append(entry._replace(offset = int(entry.offset),plies = int(entry.plies)))
+				return entries
+
+	entries = scan(pgn_file)
+	try:
+		with open(idx_file,'w') as f:
+			print >> f, key
+			for entry in entries:
+				print >> f, "\t".join(str(e) for e in entry)
+	except IOError:
+		pass
+	return entries
+
+def elo(value):
+	try:
+		return int(value)
+	except ValueError:
+		return None
+
+class GameFilter(object):
+	'''Predicate on index entries, checked before a game is parsed.
+
+	Every bound left None accepts all games. An Elo range needs both
+	ratings to lie in it; games without ratings fail it. event and
+	time_control are regular expressions searched in those headers, and
+	results a list of accepted results.
+	'''
+	def __init__(self, min_plies = None, max_plies = None, min_elo = None, max_elo = None, event = None, time_control = None, results = None):
+		self.min_plies = min_plies
+		self.max_plies = max_plies
+		self.min_elo = min_elo
+		self.max_elo = max_elo
+		self.event = re.compile(event) if event else None
+		self.time_control = re.compile(time_control) if time_control else None
+		self.results = set(results) if results else None
+
+	def __call__(self, entry):
+		if self.min_plies is not None and entry.plies < self.min_plies:
+			return False
+		if self.max_plies is not None and entry.plies > self.max_plies:
+			return False
+		if self.min_elo is not None or self.max_elo is not None:
+			for rating in (elo(entry.white_elo),elo(entry.black_elo)):
+				if rating is None:
+					return False
+				if self.min_elo is not None and rating < self.min_elo:
+					return False
+				if self.max_elo is not None and rating > self.max_elo:
+					return False
+		if self.event and not self.event.search(entry.event):
+			return False
+		if self.time_control and not self.time_control.search(entry.time_control):
+			return False
+		if self.results and entry.result not in self.results:
+			return False
+		return True
+
+	def select(self, entries):
+		'''returns the numbers of the games of entries that pass'''
+		return [n for n, entry in enumerate(entries) if self(entry)]
+
+class PGNIndex(object):
+	'''Selection of the games in a pgn file.
+
+	Slicing returns another PGNIndex over the selected games without
+	parsing anything; `numbers` holds the position of each of its games in
+	the file and `entries` the Entry of every game of the file.
+	'''
+	def __init__(self, pgn_file, numbers = None, entries = None):
+		self.pgn_file = pgn_file
+		self.entries = load_index(pgn_file) if entries is None else entries
+		self.numbers = range(len(self.entries)) if numbers is None else numbers
+
+	def __len__(self):
+		return len(self.numbers)
+
+	def __getitem__(self, g):
+		return PGNIndex(self.pgn_file,self.numbers[g],self.entries)
+
+### compact move arrays
+def encode_move(move):
+	'''
+	packs a move into 16 bits: from square, to square and promotion piece
+	type, with squares numbered as in chess.Move and MOVES
+	'''
+	return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+DECODED = {}
+def decode_move(code):
+	if code not in DECODED:
+		DECODED[code] = chess.Move(code & 63,(code >> 6) & 63,(code >> 12) or None)
+	return DECODED[code]
+
+def encode_game(game):
+	'''
+	returns the main line of a parsed game as an array of move codes, with
+	the index in TERMINALS of its final position. games that do not start
+	from the initial position are stored empty.
+	'''
+	codes = array('H')
+	if game is None or 'FEN' in game.headers:
+		return codes, 0
+	node = game
+	while node.variations:
+		node = node.variation(0)
+		codes.append(encode_move(node.move))
+	board = node.board()
+	if board.is_checkmate():
+		return codes, 1
+	if board.is_stalemate():
+		return codes, 2
+	return codes, 0
+
+class MoveCache(object):
+	'''Games of a PGNIndex as arrays of move codes.
+
+	The codes are kept in <pgn file>.moves, which is memory mapped and
+	extended whenever a run needs games that are not in it yet. The file
+	starts with a line naming the pgn file with its size and mtime,
+	followed by the number of games n, n uint32 end positions, n uint8
+	flags telling the encoded games from the ones no run has asked for,
+	n uint8 indices in TERMINALS of their final positions and the uint16
+	codes of all games, in native byte order. Games are replayed from the
+	initial position with decode_move.
+	'''
+	def __init__(self, index, cache = None):
+		self.index = index
+		if cache is None:
+			cache = self.load(index.numbers)
+		self.mm, self.ends, self.have, self.terminals, self.start = cache
+
+	def __len__(self):
+		return len(self.index)
+
+	def number(self, g):
+		'''Return the position of the g-th game in the pgn file.'''
+		return self.index.numbers[g]
+
+	def terminal(self, g):
+		'''Return 'mate', 'stalemate' or '-' for the final position of game g.'''
+		return TERMINALS[self.terminals[self.index.numbers[g]]]
+
+	def __getitem__(self, g):
+		if isinstance(g, slice):
+			return MoveCache(self.index[g],(self.mm,self.ends,self.have,self.terminals,self.start))
+
+		n = self.index.numbers[g]
+		first = self.ends[n-1] if n > 0 else 0
+		codes = array('H')
+		codes.fromstring(self.mm[self.start + 2*first:self.start + 2*self.ends[n]])
+		return codes
+
+	def key(self):
+		pgn_file = self.index.pgn_file
+		st = os.stat(pgn_file)
+		return "chess-qa moves\t{}\t{}\t{}\t{}\n".format(CACHE_VERSION,os.path.abspath(pgn_file),st.st_size,int(st.st_mtime))
+
+	def load(self, numbers):
+		'''
+		maps the cache file, first encoding the games of numbers it is
+		missing
+		'''
+		cache_file = self.index.pgn_file + '.moves'
+		key = self.key()
+		games = []
+		have = array('B')
+		terminals = array('B')
+		if os.path.exists(cache_file):
+			mm, ends, have, terminals, start = self.map(cache_file)
+			if mm[:len(key)] == key and all(n < len(have) and have[n] for n in numbers):
+				return mm, ends, have, terminals, start
+			if mm[:len(key)] == key:
+				first = 0
+				for n in xrange(len(ends)):
+					codes = array('H')
+					codes.fromstring(mm[start + 2*first:start + 2*ends[n]])
+					games.append(codes)
+					first = ends[n]
+			else:
+				have = array('B')
+				terminals = array('B')
+			mm.close()
+
+		n_games = max(numbers) + 1 if numbers else 0
+		games.extend(array('H') for n in xrange(len(games),n_games))
+		have.extend([0] * (len(games) - len(have)))
+		terminals.extend([0] * (len(games) - len(terminals)))
+		pgn = open(self.index.pgn_file,'rb')
+		for n in numbers:
+			if not have[n]:
+				pgn.seek(self.index.entries[n].offset)
+				games[n], terminals[n] = encode_game(chess.pgn.read_game(pgn))
+				have[n] = 1
+
+		ends = array('I')
+		total = 0
+		for codes in games:
+			total += len(codes)
+			ends.append(total)
+		parts = [key,array('I',[len(games)]).tostring(),ends.tostring(),have.tostring(),terminals.tostring()]
+		parts.extend(codes.tostring() for codes in games)
+		# other processes may extend the same file
+		tmp_file = "{}.{}.tmp".format(cache_file,os.getpid())
+		try:
+			with open(tmp_file,'wb') as f:
+				f.writelines(parts)
+			os.rename(tmp_file,cache_file)
+		except (IOError, OSError):
+			# a read only folder, keep the codes in memory
+			if os.path.exists(tmp_file):
+				os.remove(tmp_file)
+			return self.unpack("".join(parts))
+		return self.map(cache_file)
+
+	def map(self, cache_file):
+		with open(cache_file,'rb') as f:
+			return self.unpack(mmap.mmap(f.fileno(),0,access = mmap.ACCESS_READ))
+
+	def unpack(self, mm):
+		'''splits the contents of a cache file, mapped or in a string'''
+		header = mm.find('\n') + 1
+		count = array('I')
+		count.fromstring(mm[header:header+4])
+		n = count[0]
+		ends = array('I')
+		ends.fromstring(mm[header+4:header+4+4*n])
+		have = array('B')
+		have.fromstring(mm[header+4+4*n:header+4+5*n])
+		terminals = array('B')
+		terminals.fromstring(mm[header+4+5*n:header+4+6*n])
+		return mm, ends, have, terminals, header + 4 + 6*n
@@ -1,5 +1,15 @@
 import argparse
 
+def shard_spec(value):
+    '''parses the i/N of --shard'''
+    try:
+        i, n = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected i/N, got ' + value)
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError('shard i/N needs 0 <= i < N, got ' + value)
+    return (i, n)
+
 def get_parser():
     parser = argparse.ArgumentParser()
 
@@ -15,4 +25,60 @@ def get_parser():
 
     parser.add_argument('--path', action='store', dest='path',help='folder to produce output into ',default = 'output')
 
+    parser.add_argument('--workers', action='store', dest='workers',help='# of worker processes, each generating the questions of its own share of the dedup keys, default = 1',type=int,default = 1)
+
+    parser.add_argument('--shared-images', action='store_true', dest='shared_images',help='store one image per board placement under PATH/images and add its name as a fifth field of the .txt files, instead of a .png per question')
+
+    parser.add_argument('--output-format', action='store', dest='output_format',help='files : a .txt and a .png per question in PATH/<q type>/, jsonl or tsv : records appended to rolling shards in PATH with images in archives, default = files',choices = ['files','jsonl','tsv'],default = 'files')
+
+    parser.add_argument('--image-archive', action='store', dest='image_archive',help='archive format of the image shards, default = tar',choices = ['tar','zip'],default = 'tar')
+
+    parser.add_argument('--shard-size', action='store', dest='shard_size',help='# of questions per output shard, default = 10000',type=int,default = 10000)
+
+    parser.add_argument('--render-workers', action='store', dest='render_workers',help='# of threads rendering and writing questions in the background while positions are searched, 0 to render in the search loop, default = 0',type=int,default = 0)
+
+    parser.add_argument('--image-format', action='store', dest='image_format',help='png : board images, npy : the same pixels as uint8 arrays in .npy shards, planes : 8x8x12 one-hot piece planes in .npy shards, default = png',choices = ['png','npy','planes'],default = 'png')
+
+    parser.add_argument('--features', action='store_true', dest='features',help='answer from the per position feature table in PGN_FILE.features, building it first if needed (see features.py)')
+
+    parser.add_argument('--max-passes', action='store', dest='max_passes',help='give up on a q type after this many passes over the games, 0 for no limit, default = 0',type=int,default = 0)
+
+    parser.add_argument('--time-budget', action='store', dest='time_budget',help='give up on a q type after this many seconds, 0 for no limit, default = 0',type=float,default = 0)
+
+    parser.add_argument('--patience', action='store', dest='patience',help='# of passes over the games without a new question after which the open answer buckets of a q type count as exhausted, default = 5',type=int,default = 5)
+
+    parser.add_argument('--underfilled', action='store', dest='underfilled',help='what to do with exhausted answer buckets: drop them and generate fewer questions, or redistribute their share over the other buckets, default = drop',choices = ['drop','redistribute'],default = 'drop')
+
+    parser.add_argument('--dedup', action='store', dest='dedup',help='questions are unique by path : the moves leading to the board, or by position : the board itself, default = path',choices = ['path','position'],default = 'path')
+
+    parser.add_argument('--dedup-scope', action='store', dest='dedup_scope',help='type : unique within each question type, all : unique across all question types of the run, default = type',choices = ['type','all'],default = 'type')
+
+    parser.add_argument('--min-plies', action='store', dest='min_plies',help='only read games of at least this many plies',type=int,default = None)
+
+    parser.add_argument('--max-plies', action='store', dest='max_plies',help='only read games of at most this many plies',type=int,default = None)
+
+    parser.add_argument('--min-elo', action='store', dest='min_elo',help='only read games where both players are rated at least this',type=int,default = None)
+
+    parser.add_argument('--max-elo', action='store', dest='max_elo',help='only read games where both players are rated at most this',type=int,default = None)
+
+    parser.add_argument('--event', action='store', dest='event',help='only read games whose Event header matches this regular expression',default = None)
+
+    parser.add_argument('--time-control', action='store', dest='time_control',help='only read games whose TimeControl header matches this regular expression',default = None)
+
+    parser.add_argument('--result', action='append', dest='results',help='only read games with this result, may be repeated',choices = ['1-0','0-1','1/2-1/2','*'],default = None)
+
+    parser.add_argument('--checkpoint-every', action='store', dest='checkpoint_every',help='save a checkpoint of the run in PATH every this many games, 0 for none, default = 1000',type=int,default = 1000)
+
+    parser.add_argument('--resume', action='store_true', dest='resume',help='continue an interrupted run from its last checkpoint, with the same options; the output is the same as that of an uninterrupted run')
+
+    parser.add_argument('--shard', action='store', dest='shard',help='build the i-th of N shards of a dataset, as i/N: every i/N run with otherwise the same options takes every N-th game and 1/N of every answer bucket, and writes into its own PATH a qa-s<i>.manifest for merge.py, default = 0/1',type=shard_spec,default = (0,1))
+
+    parser.add_argument('--extend', action='store_true', dest='extend',help='add to the finished run in PATH, with the same options, the questions it needs to reach a larger --total-count, keeping its answer balance and dedup keys')
+
+    parser.add_argument('--progress-every', action='store', dest='progress_every',help='print a progress line every this many seconds, 0 for only at the end, default = 10',type=float,default = 10)
+
+    parser.add_argument('--metrics-file', action='store', dest='metrics_file',help='save the counters and timers of the run as json to this file with every progress line; the files of workers and shards add their name to it',default = None)
+
+    parser.add_argument('--profile', action='store_true', dest='profile',help='run under cProfile, saving the stats to PATH/<name>.prof and printing the 30 functions with the most cumulative time')
+
     return parser
@@ -15,6 +15,10 @@ See: http://en.wikipedia.org/wiki/Forsyth-Edwards_Notation
 '''
 import re, string
 from PIL import Image,ImageDraw,ImageFont
+try:
+	import numpy as np
+except ImportError:
+	np = None
 
 class BadChessboard(ValueError):
 	pass
@@ -74,10 +78,28 @@ def draw_board(n=8, sq_size=(20, 20)):
 		draw_square(white_square, fill='white')
 	return board
 	
+FONT = {}
+def load_font(name = "arial.ttf", size = 11):
+	'''Return the font, loading it only once per process.'''
+	if (name, size) not in FONT:
+		FONT[name, size] = ImageFont.truetype(name, size)
+	return FONT[name, size]
+
+def draw_labels(board):
+	'''Draw the file and rank coordinates onto a board image.'''
+	d = ImageDraw.Draw(board)
+	font = load_font()
+	x = string.lowercase[:8]
+	for i in xrange(0,8):
+		d.text( ( 45 + i*50, 388) , x[i] , fill = (0,256), font = font)
+		d.text( (1, 350 - i*50) , str(i+1) , fill = (0,256), font = font)
+	return board
+
 class DrawChessPosition(object):
 	'''Chess position renderer.
 	
-	Create an instance of this class, then call 
+	Create an instance of this class, or share the one returned by
+	renderer(), then call draw.
 	'''
 	def __init__(self):
 		'''Initialise, preloading pieces and creating a blank board.''' 
@@ -96,6 +118,8 @@ class DrawChessPosition(object):
 		blacks = 'kqbnrp'
 		piece_images.update(dict(
 			zip(blacks, (Image.open('pieces/%s.png' % p) for p in blacks))))
+		for piece in piece_images.values():
+			piece.load()
 		piece_sizes = set(piece.size for piece in piece_images.values())
 		# Sanity check: the pieces should all be the same size
 		assert len(piece_sizes) == 1
@@ -105,8 +129,8 @@ class DrawChessPosition(object):
 								 self.piece_images.iteritems())
 	
 	def create_blank_board(self):
-		'''Pre-render a blank board.'''
-		self.board = draw_board(sq_size=(self.piece_w, self.piece_h))
+		'''Pre-render a blank board with its coordinate labels.'''
+		self.board = draw_labels(draw_board(sq_size=(self.piece_w, self.piece_h)))
 	
 	def point(self, i, j):
 		'''Return the top left of the square at (i, j).'''
@@ -135,11 +159,80 @@ class DrawChessPosition(object):
 		for pt, piece in filter(not_blank, zip(pts, pieces)):
 			board.paste(images[piece], pt, masks[piece])
 
-		d = ImageDraw.Draw(board)
-		font = ImageFont.truetype("arial.ttf",11)
-		x = string.lowercase[:8]
-		for i in xrange(0,8):
-			d.text( ( 45 + i*50, 388) , x[i] , fill = (0,256), font = font)
-			d.text( (1, 350 - i*50) , str(i+1) , fill = (0,256), font = font)
-
 		return board
+
+RENDERER = []
+def renderer():
+	'''Return the renderer shared by this process.
+
+	Piece sprites, masks, the font and the labelled blank board are
+	loaded once and reused for every image.
+	'''
+	if not RENDERER:
+		RENDERER.append(DrawChessPosition())
+	return RENDERER[0]
+
+PLANES = 'KQBNRPkqbnrp'
+
+class ArrayChessPosition(object):
+	'''Chess position renderer producing NumPy arrays.
+
+	The image of every (square, piece) pair is rendered once with a
+	DrawChessPosition, so draw only gathers 64 of these tiles with array
+	indexing. The result has the pixels of DrawChessPosition.draw.
+	'''
+	def __init__(self, drawer):
+		if np is None:
+			raise ImportError('numpy is needed to render boards to arrays')
+		n, w, h = drawer.n, drawer.piece_w, drawer.piece_h
+		contents = ' ' + PLANES
+		layers = len(drawer.board.getbands())
+		self.tiles = np.empty((n * n, len(contents), h, w, layers), np.uint8)
+		for k in range(n * n):
+			x, y = drawer.point(k % n, k // n)
+			blank = drawer.board.crop((x, y, x + w, y + h))
+			for c, piece in enumerate(contents):
+				tile = blank.copy()
+				if piece != ' ':
+					tile.paste(drawer.piece_images[piece], (0, 0), drawer.piece_masks[piece])
+				self.tiles[k, c] = np.asarray(tile).reshape(h, w, layers)
+		self.lut = np.zeros(256, np.intp)
+		for c, piece in enumerate(contents):
+			self.lut[ord(piece)] = c
+		self.squares = np.arange(n * n)
+		self.n = n
+		self.shape = (n * h, n * w, layers)
+
+	def draw(self, fen):
+		'''Return an array depicting the input position.'''
+		n = self.n
+		pieces = self.lut[np.frombuffer(expand_fen(fen).encode('ascii'), np.uint8)]
+		tiles = self.tiles[self.squares, pieces]
+		h, w, layers = tiles.shape[1:]
+		return tiles.reshape(n, n, h, w, layers).transpose(0, 2, 1, 3, 4).reshape(self.shape)
+
+def fen_planes(fen):
+	'''Return the position as 8 x 8 x 12 one-hot piece planes.
+
+	Ranks run from 8 to 1 and files from a to h, as in the FEN. Plane k
+	marks the squares of piece PLANES[k].
+	'''
+	if np is None:
+		raise ImportError('numpy is needed to encode boards as planes')
+	pieces = np.frombuffer(expand_fen(fen).encode('ascii'), np.uint8)
+	planes = np.zeros((64, len(PLANES) + 1), np.uint8)
+	planes[np.arange(64), PLANE_LUT[pieces]] = 1
+	return planes[:, :len(PLANES)].reshape(8, 8, len(PLANES))
+
+if np is not None:
+	PLANE_LUT = np.empty(256, np.intp)
+	PLANE_LUT.fill(len(PLANES))
+	for k, piece in enumerate(PLANES):
+		PLANE_LUT[ord(piece)] = k
+
+ARRAY_RENDERER = []
+def array_renderer():
+	'''Return the ArrayChessPosition shared by this process.'''
+	if not ARRAY_RENDERER:
+		ARRAY_RENDERER.append(ArrayChessPosition(renderer()))
+	return ARRAY_RENDERER[0]